@@ -1,21 +1,8 @@
-import requests
-from sys import argv
-import sys, getopt
-import os
-import json
-import re
-sys.path.append('..')
-from sanskrit_data.schema.common import JsonObject, JsonObjectNode, DataSource
-from sanskrit_data.schema.users import *
-from sanskrit_data.schema.ullekhanam import *
-from sanskrit_data.schema.books import *
-from vedavaapi.client import VedavaapiClient, DotDict, print_dict
-
-def import_books(rootdir):
-    logging.info("Importing books into database from " + rootdir)
-    '''
-    model book.json metadata for importing:--
-    
+"""
+imports scanned books into ullekhanam, through /trees and /resources/<id>/files api.
+
+each book is a directory with a book.json like::
+
     {
       "title" : "a_title",
       "author" : "author_1,author_2,comma_seperated_authors",
@@ -25,138 +12,338 @@ def import_books(rootdir):
         },
         {
           "fname" : "page_163.jpg"
-        },
-        {
-          "fname" : "page_164.jpg"
         }
       ]
     }
-    '''
-    mybooks = []
+
+optional "content" in book.json, or in a page entry, is merged into that node's json, to fill in any schema details.
+
+a book and all of it's pages are created with one tree request, and then page images are uploaded
+concurrently by a bounded pool of workers, over one pooled http session.
+progress is appended to a checkpoint file, so that an interrupted import can be resumed by running same command again;
+books already imported, and pages already uploaded are skipped.
+"""
+import getopt
+import json
+import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from requests.adapters import HTTPAdapter
+
+sys.path.append('..')
+from vedavaapi.client import VedavaapiClient, DotDict
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(asctime)s {%(filename)s:%(lineno)d}: %(message)s")
+
+
+def find_books(rootdir):
+    """
+    yields (book_dir, book_json) for all book.json files under rootdir.
+    """
+    logging.info("finding books in " + rootdir)
     for root, directories, filenames in os.walk(rootdir):
-      for filename in filenames:
-        if not re.search("book.json$", os.path.basename(filename)):
-            continue
-
-        f = os.path.join(root,filename)
-        logging.info("    " + f)
-        (bookdir, bookpath) = os.path.split(f)
-        with open(f) as fh:
+        directories.sort()
+        for filename in sorted(filenames):
+            if not re.search("book.json$", os.path.basename(filename)):
+                continue
+            book_file_path = os.path.join(root, filename)
+            with open(book_file_path) as fh:
+                try:
+                    book = json.loads(fh.read())
+                except Exception as e:
+                    logging.error("error reading {}: {}".format(book_file_path, e))
+                    continue
+            yield os.path.abspath(root), book
+
+
+def book_tree(book):
+    book_content = {
+        "jsonClass": "BookPortion",
+        "title": {"jsonClass": "Text", "chars": book["title"]},
+        "metadata": [
+            {"label": "author", "value": author.strip()} for author in book.get("author", "").split(',')
+            if author.strip()
+        ]
+    }
+    book_content.update(book.get("content", {}))
+
+    page_branches = []
+    for n, page in enumerate(book["pages"]):
+        page_content = {
+            "jsonClass": "Page",
+            "label": "page {}".format(n + 1)
+        }
+        page_content.update(page.get("content", {}))
+        page_branches.append({"content": page_content})
+
+    return {"content": book_content, "sections": page_branches}
+
+
+class Checkpoint(object):
+    """
+    append only log of import progress. each line is one of::
+
+        {"event": "book", "book_dir": ..., "book_id": ..., "page_ids": [...]}
+        {"event": "page", "book_dir": ..., "fname": ...}
+        {"event": "book_done", "book_dir": ...}
+
+    it is written only from main thread, and flushed after every line, hence survives crashes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.books = {}
+        self.uploaded_pages = {}
+        self.done_books = set()
+        if os.path.exists(path):
+            self._load()
+        self.fh = open(path, 'a')
+
+    def _load(self):
+        with open(self.path) as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # partially written last line of a crashed run
+                    continue
+                book_dir = record['book_dir']
+                if record['event'] == 'book':
+                    self.books[book_dir] = record
+                elif record['event'] == 'page':
+                    self.uploaded_pages.setdefault(book_dir, set()).add(record['fname'])
+                elif record['event'] == 'book_done':
+                    self.done_books.add(book_dir)
+
+    def _append(self, record):
+        self.fh.write(json.dumps(record) + '\n')
+        self.fh.flush()
+
+    def book_created(self, book_dir, book_id, page_ids):
+        record = {"event": "book", "book_dir": book_dir, "book_id": book_id, "page_ids": page_ids}
+        self.books[book_dir] = record
+        self._append(record)
+
+    def page_uploaded(self, book_dir, fname):
+        self.uploaded_pages.setdefault(book_dir, set()).add(fname)
+        self._append({"event": "page", "book_dir": book_dir, "fname": fname})
+
+    def book_done(self, book_dir):
+        self.done_books.add(book_dir)
+        self._append({"event": "book_done", "book_dir": book_dir})
+
+    def close(self):
+        self.fh.close()
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.start = time.time()
+        self.books = 0
+        self.books_skipped = 0
+        self.pages = 0
+        self.pages_skipped = 0
+        self.bytes = 0
+        self.failures = 0
+        self.tree_seconds = 0
+        self.upload_seconds = 0
+
+    def report(self):
+        elapsed = time.time() - self.start
+        logging.info("imported {} books ({} skipped), uploaded {} pages ({} skipped), {} failures".format(
+            self.books, self.books_skipped, self.pages, self.pages_skipped, self.failures))
+        logging.info("{:.1f}s elapsed; {:.2f} books/s, {:.2f} pages/s, {:.2f} MB/s".format(
+            elapsed, self.books / elapsed, self.pages / elapsed, self.bytes / elapsed / (1024 * 1024)))
+        if self.books:
+            logging.info("{:.3f}s per tree request".format(self.tree_seconds / self.books))
+        if self.pages:
+            logging.info("{:.3f}s per page upload (per worker)".format(self.upload_seconds / self.pages))
+
+
+class BookImporter(object):
+
+    def __init__(self, vvclient, checkpoint, max_workers=8, bulk=True):
+        self.vvclient = vvclient
+        self.checkpoint = checkpoint
+        self.max_workers = max_workers
+        self.bulk = bulk
+        self.stats = Stats()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.in_flight = {}
+        self.pending_pages = {}
+        self.failed_books = set()
+
+    def create_book(self, book_dir, book):
+        start = time.time()
+        r = self.vvclient.post(
+            "ullekhanam/v1/trees",
+            parms={"trees": json.dumps([book_tree(book)]), "bulk": json.dumps(self.bulk)})
+        self.stats.tree_seconds += time.time() - start
+        if not r:
+            raise IOError("could not create book {}".format(book_dir))
+        result = r.json()
+        result_tree = result["trees"][0] if self.bulk else result[0]
+        book_id = result_tree["content"]["_id"]
+        page_ids = [branch["content"]["_id"] for branch in result_tree.get("sections", [])]
+        self.checkpoint.book_created(book_dir, book_id, page_ids)
+        return book_id, page_ids
+
+    def upload_page(self, page_id, page_file_path):
+        """
+        runs in worker threads. file is opened only for duration of it's upload.
+        """
+        start = time.time()
+        with open(page_file_path, 'rb') as fh:
+            r = self.vvclient.post(
+                "ullekhanam/v1/resources/{}/files".format(page_id),
+                parms={"files_purpose": "source"},
+                files=[('files', (os.path.basename(page_file_path), fh))])
+        if not r:
+            raise IOError("could not upload {}".format(page_file_path))
+        return os.path.getsize(page_file_path), time.time() - start
+
+    def import_book(self, book_dir, book):
+        if book_dir in self.checkpoint.done_books:
+            self.stats.books_skipped += 1
+            return
+
+        if book_dir in self.checkpoint.books:
+            page_ids = self.checkpoint.books[book_dir]["page_ids"]
+        else:
+            _, page_ids = self.create_book(book_dir, book)
+            self.stats.books += 1
+
+        uploaded = self.checkpoint.uploaded_pages.get(book_dir, set())
+        self.pending_pages[book_dir] = 0
+        for page, page_id in zip(book["pages"], page_ids):
+            if page["fname"] in uploaded:
+                self.stats.pages_skipped += 1
+                continue
+            self._wait_for_slot()
+            future = self.executor.submit(self.upload_page, page_id, os.path.join(book_dir, page["fname"]))
+            self.in_flight[future] = (book_dir, page["fname"])
+            self.pending_pages[book_dir] += 1
+        if not self.pending_pages[book_dir]:
+            self._finish_book(book_dir)
+
+    def _wait_for_slot(self):
+        # keeps at most two uploads queued per worker, so that files of all books are not queued up at once.
+        while len(self.in_flight) >= 2 * self.max_workers:
+            self._collect(wait(list(self.in_flight.keys()), return_when=FIRST_COMPLETED).done)
+
+    def _collect(self, futures):
+        for future in futures:
+            book_dir, fname = self.in_flight.pop(future)
+            self.pending_pages[book_dir] -= 1
             try:
-                b = json.loads(fh.read())
+                size, seconds = future.result()
             except Exception as e:
-                print("Error reading ",f, ": ", e)
-                continue
+                logging.error(str(e))
+                self.stats.failures += 1
+                # book will not be marked done; it's failed pages will be retried on resume.
+                self.failed_books.add(book_dir)
+            else:
+                self.checkpoint.page_uploaded(book_dir, fname)
+                self.stats.pages += 1
+                self.stats.bytes += size
+                self.stats.upload_seconds += seconds
+            if self.pending_pages[book_dir] == 0:
+                self._finish_book(book_dir)
+
+    def _finish_book(self, book_dir):
+        self.pending_pages.pop(book_dir, None)
+        if book_dir in self.failed_books:
+            logging.error("some pages of {} could not be uploaded".format(book_dir))
+            return
+        self.checkpoint.book_done(book_dir)
+        logging.info("imported " + book_dir)
+
+    def finish(self):
+        while len(self.in_flight):
+            self._collect(wait(list(self.in_flight.keys()), return_when=FIRST_COMPLETED).done)
+        self.executor.shutdown()
 
-        # Create BookPortion objects for all pages
-        pagenum = 0
-        pages = []
-        files_to_upload = []
-        for p in b["pages"]:
-            pagenum = pagenum + 1
-            fname = p["fname"]
-            #files_to_upload.append(('files', (fname, open(os.path.join(bookdir, fname), 'rb'))))
-
-            pg_target = BookPositionTarget.from_details(position=pagenum, container_id='undefined')
-            page = BookPortion.from_details("", path=fname, portion_class='page',
-                    base_data='image',
-                    targets=[pg_target])
-            pages.append(JsonObjectNode.from_details(content=page))
-
-        authors = []
-        for a in b["author"].split(','):
-            if a:
-                authors.append(NamedEntity.from_name_string(a))
-
-        # Create a BookPortion object for the book and add pages as children
-        book = BookPortion.from_details(
-            b["title"],
-            authors=authors,
-            base_data='image',
-            portion_class="book",
-            path=bookdir,
-            source=DataSource.from_details(source_type="user_supplied", id="book_importer"))
-
-        booknode = JsonObjectNode.from_details(content=book, children=pages)
-        yield booknode
 
 (cmddir, cmdname) = os.path.split(__file__)
 
+
 def usage():
-    print(cmdname + " [-r] [-u <username>:<password>] [-i <repo_id>] -s <serverurl> <books_rootdir>")
+    print(cmdname + " [-u <username>:<password>] [-i <repo_id>] [-w <workers>] [-c <checkpoint_file>] [-n]"
+                    " -s <serverurl> <books_rootdir> ...")
+    print("    -w: number of concurrent page uploads (default 8)")
+    print("    -c: checkpoint file, to resume interrupted imports (default import_books.checkpoint)")
+    print("    -n: create each book tree node by node, instead of in bulk")
     exit(1)
 
+
 def main(argv):
     parms = DotDict({
-        'reset' : False,
-        'dbgFlag' : True,
-        'server_baseurl' : '',
-        'auth' : DotDict({'user' : 'vedavaapiAdmin', 'passwd' : '@utoDump1'}),
-        'repo_id' : 'vedavaapi_test'})
+        'server_baseurl': '',
+        'auth': DotDict({'user': 'vedavaapiAdmin', 'passwd': '@utoDump1'}),
+        'repo_id': 'vedavaapi_test',
+        'workers': 8,
+        'checkpoint': 'import_books.checkpoint',
+        'bulk': True})
 
     try:
-        opts, args = getopt.getopt(argv, "hru:i:s:", ["url="])
-    except getopt.GetoptError:
-        logging.info("Error in command line: ", getopt.GetoptError)
+        opts, args = getopt.getopt(argv, "hu:i:s:w:c:n", ["url="])
+    except getopt.GetoptError as e:
+        logging.error("error in command line: {}".format(e))
         usage()
     for opt, arg in opts:
         if opt == '-h':
             usage()
-        elif opt in ("-r", "--reset"):
-            parms.reset = True
         elif opt in ("-u", "--auth"):
             parms.auth = DotDict(dict(zip(('user', 'passwd'), arg.split(':'))))
-            print(parms.auth)
         elif opt in ("-i", "--repo_id"):
             parms.repo_id = arg
         elif opt in ("-s", "--serverurl"):
-            logging.info("server url = ", arg)
             parms.server_baseurl = arg
-        else:
-            logging.info("Unknown parameter: ", opt)
-            usage()
+        elif opt == "-w":
+            parms.workers = int(arg)
+        elif opt == "-c":
+            parms.checkpoint = arg
+        elif opt == "-n":
+            parms.bulk = False
 
     if not parms.server_baseurl:
-        logging.info("Error: Supply server URL via -s.")
+        logging.error("supply server url via -s.")
         usage()
     if not args:
-        logging.info("Error: Missing book path to import...")
+        logging.error("missing book path to import.")
         usage()
 
     vvclient = VedavaapiClient(parms.server_baseurl, parms.repo_id)
     if not vvclient.authenticate(parms.auth):
         sys.exit(1)
+    if hasattr(vvclient, 'session'):
+        # one keep-alive connection per worker, instead of a new connection per request
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=parms.workers + 1, max_retries=3)
+        vvclient.session.mount('http://', adapter)
+        vvclient.session.mount('https://', adapter)
 
-    for path in args:
-        for book in import_books(path):
-            pages = []
-            for page in book.children:
-                pages.append(('in_files',
-                              open(os.path.join(book.content.path, page.content.path), 'rb')))
-            #print_dict(book.content.to_json_map())
-            r = vvclient.post("ullekhanam/v1/books", parms={'book_json' : json.dumps(book.content.to_json_map())}, files=pages)
-            if not r:
-                sys.exit(1)
-            book_json = json.loads(r.text)
-            book = JsonObject.make_from_dict(book_json["content"])
-            #print_dict(book_json['content'])
-            url = "ullekhanam/v1/entities/{}".format(book._id)
-
-            r = vvclient.get(url, {'depth' : 1})
-            if not r:
-                logging.error("Error: invoking {}".format(url))
-                continue
+    checkpoint = Checkpoint(parms.checkpoint)
+    importer = BookImporter(vvclient, checkpoint, max_workers=parms.workers, bulk=parms.bulk)
+    try:
+        for path in args:
+            for book_dir, book in find_books(path):
+                try:
+                    importer.import_book(book_dir, book)
+                except IOError as e:
+                    logging.error(str(e))
+                    importer.stats.failures += 1
+    except KeyboardInterrupt:
+        logging.info("interrupted; finishing uploads in progress. run again to resume.")
+    finally:
+        importer.finish()
+        checkpoint.close()
+        importer.stats.report()
 
-            book_info = r.json()
-            for p in book_info['children']:
-                logging.info("page id " + p['content']['title'])
-                page_id = p['content']['_id']
-                url = "ullekhanam/v1/pages/{}/annotations".format(page_id)
-                r = vvclient.get(url)
-                if not r:
-                    sys.exit(1)
-                print_dict(r.json())
-if __name__ == "__main__":
-   main(sys.argv[1:])
 
-# TODO to be modded for new api.
\ No newline at end of file
+if __name__ == "__main__":
+    main(sys.argv[1:])
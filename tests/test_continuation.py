@@ -0,0 +1,112 @@
+import base64
+import json
+
+import pytest
+
+bson = pytest.importorskip('bson')
+helper = pytest.importorskip('vedavaapi.ullekhanam.api.helper')
+
+ObjectId = bson.ObjectId
+
+
+def test_normalized_sort_spec_appends_id():
+    assert helper.normalized_sort_spec(None) == [('_id', 1)]
+    assert helper.normalized_sort_spec({"title.chars": -1}) == [('title.chars', -1), ('_id', 1)]
+    assert helper.normalized_sort_spec([["a", 1], ["b", -1]]) == [('a', 1), ('b', -1), ('_id', 1)]
+
+
+def test_normalized_sort_spec_keeps_given_id_direction():
+    assert helper.normalized_sort_spec([["_id", -1]]) == [('_id', -1)]
+    assert helper.normalized_sort_spec([["a", 1], ["_id", -1]]) == [('a', 1), ('_id', -1)]
+
+
+@pytest.mark.parametrize('sort_doc', [
+    [["a", 2]],
+    [["a", "asc"]],
+    [[1, 1]],
+    [["a", 1, 1]],
+])
+def test_normalized_sort_spec_rejects_invalid(sort_doc):
+    with pytest.raises(ValueError):
+        helper.normalized_sort_spec(sort_doc)
+
+
+def test_keyset_selector_mixed_directions():
+    oid = ObjectId()
+    sort_spec = [('a', 1), ('b', -1), ('_id', 1)]
+    selector = helper.keyset_selector(sort_spec, [5, 'x', str(oid)])
+    assert selector == {"$or": [
+        {"a": {"$gt": 5}},
+        {"a": 5, "$or": [{"b": {"$lt": 'x'}}, {"b": None}]},
+        {"a": 5, "b": 'x', "_id": {"$gt": oid}},
+    ]}
+
+
+def test_keyset_selector_id_tie_break_descending():
+    oid = ObjectId()
+    selector = helper.keyset_selector([('a', 1), ('_id', -1)], [5, oid])
+    assert selector == {"$or": [
+        {"a": {"$gt": 5}},
+        {"a": 5, "$or": [{"_id": {"$lt": oid}}, {"_id": None}]},
+    ]}
+
+
+def test_keyset_selector_keeps_non_object_ids():
+    selector = helper.keyset_selector([('_id', 1)], ['some_id'])
+    assert selector == {"$or": [{"_id": {"$gt": 'some_id'}}]}
+
+
+def test_keyset_selector_null_values():
+    oid = ObjectId()
+    # nulls sort first; so after a null, ascending keys go on to non nulls, and descending ones have nothing.
+    assert helper.keyset_selector([('a', 1), ('_id', 1)], [None, oid]) == {"$or": [
+        {"a": {"$ne": None}},
+        {"a": None, "_id": {"$gt": oid}},
+    ]}
+    assert helper.keyset_selector([('a', -1), ('_id', 1)], [None, oid]) == {"$or": [
+        {"a": None, "_id": {"$gt": oid}},
+    ]}
+
+
+def test_continuation_token_round_trip():
+    oid = ObjectId()
+    sort_spec = [('title.chars', -1), ('_id', 1)]
+    token = helper.encode_continuation_token(sort_spec, {"_id": oid, "title": {"chars": "abc"}})
+    decoded_sort_spec, last_values = helper.decode_continuation_token(token)
+    assert decoded_sort_spec == sort_spec
+    assert last_values == ["abc", oid]
+    assert isinstance(last_values[1], ObjectId)
+
+
+def test_continuation_token_missing_values_are_null():
+    token = helper.encode_continuation_token([('a.b', 1), ('_id', 1)], {"_id": "x", "a": 1})
+    assert helper.decode_continuation_token(token) == ([('a.b', 1), ('_id', 1)], [None, "x"])
+
+
+def _token(token_doc):
+    return base64.urlsafe_b64encode(json.dumps(token_doc).encode('utf-8')).decode('ascii')
+
+
+@pytest.mark.parametrize('continuation_token', [
+    'not a token',
+    'bm90IGpzb24=',
+    _token([1, 2]),
+    _token({"sort": [["_id", 1]]}),
+    _token({"sort": [["a", 1], ["_id", 1]], "last": [1]}),
+    _token({"sort": [["a", 5], ["_id", 1]], "last": [1, 2]}),
+    _token({"sort": [["a", 1]], "last": [1]}),
+    _token({"sort": [["a"]], "last": [1]}),
+    _token({"sort": [["_id", 1]], "last": 1}),
+])
+def test_malformed_continuation_tokens(continuation_token):
+    # rest layer answers ValueErrors with 400.
+    with pytest.raises(ValueError):
+        helper.decode_continuation_token(continuation_token)
+    with pytest.raises(ValueError):
+        helper.read_page_by_continuation(None, {}, 10, continuation_token=continuation_token)
+
+
+def test_sort_doc_should_match_token():
+    token = helper.encode_continuation_token([('a', 1), ('_id', 1)], {"_id": "x", "a": 1})
+    with pytest.raises(ValueError):
+        helper.read_page_by_continuation(None, {}, 10, sort_doc={"a": -1}, continuation_token=token)
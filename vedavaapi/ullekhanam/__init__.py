@@ -2,10 +2,16 @@ import logging
 
 import os
 
+from pymongo import ReturnDocument, UpdateOne
 from vedavaapi.objectdb.mydb import MyDbCollection
 from vedavaapi.common import VedavaapiService, ServiceRepo
 
+from . import db_indexes, content_store, validation
+from .schema_payloads import SchemaPayloads
 from .iiif_helper import UllekhanamFSHelper, UllekhanamPreziInterface
+from .jobs import JobRunner, JobStore
+from .metrics import ApiMetrics
+from .query_profiler import QueryProfiler
 
 
 logging.basicConfig(
@@ -26,6 +32,16 @@ class UllekhanamRepo(ServiceRepo):
         self.ullekhanam_colln = self.ullekhanam_db.get_collection(
             self.ullekhanam_db_config['collections']['ullekhanam']
         )
+        # sidecar collections for repo bookkeeping (like write version, jobs), which should not mix with resources
+        self.meta_colln = self.ullekhanam_db.get_collection(
+            self.ullekhanam_db_config['collections'].get('meta', 'ullekhanam_meta')
+        )
+        self.jobs_colln = self.ullekhanam_db.get_collection(
+            self.ullekhanam_db_config['collections'].get('jobs', 'ullekhanam_jobs')
+        )
+        self.blob_refs_colln = self.ullekhanam_db.get_collection(
+            self.ullekhanam_db_config['collections'].get('blob_refs', 'ullekhanam_blob_refs')
+        )
 
         self.root_dir_path = self.store.file_store_path(
             repo_name=self.repo_name,
@@ -61,8 +77,110 @@ class UllekhanamRepo(ServiceRepo):
             base_path=base_path
         )
 
+    def content_store(self):
+        if not hasattr(self, 'blobs_store'):
+            self.blobs_store = content_store.ContentAddressedStore(
+                self.store.file_store_path(
+                    repo_name=self.repo_name,
+                    service_name=self.service.name,
+                    file_store_type='data',
+                    base_path='_blobs'
+                ),
+                self.blob_refs_colln.mongo_collection,
+                grace_seconds=self.service.config.get('blobs_grace_seconds', 60)
+            )
+        return self.blobs_store
+
+    def file_path(self, resource_id, path_in_resource_scope):
+        """
+        absolute path of a file annotated to resource, whether stored in resource's directory,
+        or in content addressed store.
+        """
+        blob_reference = content_store.parse_path_reference(path_in_resource_scope)
+        if blob_reference is not None:
+            return self.content_store().blob_path(blob_reference[0], file_name=blob_reference[1])
+        return self.resource_file_path(resource_id, path_in_resource_scope)
+
+    def job_store(self):
+        if not hasattr(self, 'jobs_store'):
+            self.jobs_store = JobStore(self.jobs_colln.mongo_collection)
+        return self.jobs_store
+
+    def query_profiler(self):
+        """
+        :return: QueryProfiler of repo's collection, or None, if profiling is disabled.
+        """
+        profiler_config = self.service.config.get('query_profiler', {})
+        if not profiler_config.get('enabled', True):
+            return None
+        if not hasattr(self, 'colln_query_profiler'):
+            self.colln_query_profiler = QueryProfiler(
+                self.ullekhanam_colln.mongo_collection,
+                slow_query_ms=profiler_config.get('slow_query_ms', 200),
+                max_shapes=profiler_config.get('max_shapes', 1000),
+                samples_per_shape=profiler_config.get('samples_per_shape', 1000))
+        return self.colln_query_profiler
+
     def initialize(self):
-        pass
+        created_indexes = db_indexes.ensure_indexes(self.ullekhanam_colln.mongo_collection)
+        if len(created_indexes):
+            logging.info('created indexes {} for repo {}'.format(created_indexes, self.repo_name))
+        self.job_store().ensure_indexes()
+        interrupted_count = self.job_store().fail_stale_jobs(JobRunner.stale_seconds)
+        if interrupted_count:
+            logging.info('marked {} interrupted jobs of repo {} as failed'.format(interrupted_count, self.repo_name))
+
+    def index_report(self):
+        return db_indexes.index_report(self.ullekhanam_colln.mongo_collection)
+
+    def write_version(self):
+        """
+        a counter, which is incremented on every write through REST endpoints.
+        kept in db, so that it is consistent across worker processes; used for etags.
+        """
+        version_doc = self.meta_colln.mongo_collection.find_one({"_id": "write_version"})
+        return version_doc['version'] if version_doc is not None else 0
+
+    def bump_write_version(self):
+        version_doc = self.meta_colln.mongo_collection.find_one_and_update(
+            {"_id": "write_version"}, {"$inc": {"version": 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+        return version_doc['version']
+
+    def book_versions(self, book_ids):
+        """
+        per book counters, incremented whenever a book or any of it's dependents change.
+        used by worker processes to check whether their materializations of a book are still current.
+
+        :return: dict of book_id to version; books which never changed are at 0.
+        """
+        version_docs = self.meta_colln.mongo_collection.find(
+            {"_id": {"$in": ['book_version:' + book_id for book_id in book_ids]}})
+        versions = dict((book_id, 0) for book_id in book_ids)
+        for version_doc in version_docs:
+            versions[version_doc['_id'][len('book_version:'):]] = version_doc['version']
+        return versions
+
+    def bump_book_versions(self, book_ids):
+        if not len(book_ids):
+            return
+        self.meta_colln.mongo_collection.bulk_write([
+            UpdateOne({"_id": 'book_version:' + book_id}, {"$inc": {"version": 1}}, upsert=True)
+            for book_id in book_ids
+        ], ordered=False)
+
+    def books_index_version(self):
+        """
+        a counter, incremented whenever books are added, removed or retitled, in any process.
+        ordered books indexes of worker processes rebuild when it moves past theirs.
+        """
+        version_doc = self.meta_colln.mongo_collection.find_one({"_id": "books_index_version"})
+        return version_doc['version'] if version_doc is not None else 0
+
+    def bump_books_index_version(self):
+        version_doc = self.meta_colln.mongo_collection.find_one_and_update(
+            {"_id": "books_index_version"}, {"$inc": {"version": 1}}, upsert=True,
+            return_document=ReturnDocument.AFTER)
+        return version_doc['version']
 
 
 class VedavaapiUllekhanam(VedavaapiService):
@@ -78,6 +196,10 @@ class VedavaapiUllekhanam(VedavaapiService):
     def __init__(self, registry, name, conf):
         super(VedavaapiUllekhanam, self).__init__(registry, name, conf)
         self.vvstore = self.registry.lookup("store")
+        self.job_runner = JobRunner(max_workers=self.config.get('job_workers', 4))
+        logging.info('compiled schema validators of {} classes'.format(validation.prime_validators()))
+        self.schema_payloads = SchemaPayloads()
+        self.metrics = ApiMetrics() if self.config.get('metrics', {}).get('enabled', True) else None
 
     def colln(self, repo_name):
         return self.get_repo(repo_name).ullekhanam_colln  # type: MyDbCollection
@@ -91,8 +213,44 @@ class VedavaapiUllekhanam(VedavaapiService):
     def resource_file_path(self, repo_name, resource_id, file_name):
         return self.get_repo(repo_name).resource_file_path(resource_id, file_name)
 
+    def file_path(self, repo_name, resource_id, path_in_resource_scope):
+        return self.get_repo(repo_name).file_path(resource_id, path_in_resource_scope)
+
+    def content_store(self, repo_name):
+        return self.get_repo(repo_name).content_store()
+
     def prezi_interface(self, repo_name):
         return self.get_repo(repo_name).prezi_interface()
 
+    def job_store(self, repo_name):
+        return self.get_repo(repo_name).job_store()
+
+    def query_profiler(self, repo_name):
+        return self.get_repo(repo_name).query_profiler()
+
     def fs_helper(self, repo_name):
         return self.get_repo(repo_name).fs_helper()
+
+    def index_report(self, repo_name):
+        return self.get_repo(repo_name).index_report()
+
+    def write_version(self, repo_name):
+        return self.get_repo(repo_name).write_version()
+
+    def bump_write_version(self, repo_name):
+        return self.get_repo(repo_name).bump_write_version()
+
+    def book_versions(self, repo_name, book_ids):
+        return self.get_repo(repo_name).book_versions(book_ids)
+
+    def bump_book_versions(self, repo_name, book_ids):
+        return self.get_repo(repo_name).bump_book_versions(book_ids)
+
+    def books_index_version(self, repo_name):
+        return self.get_repo(repo_name).books_index_version()
+
+    def bump_books_index_version(self, repo_name):
+        return self.get_repo(repo_name).bump_books_index_version()
+
+    def ensure_indexes(self, repo_name):
+        return db_indexes.ensure_indexes(self.colln(repo_name).mongo_collection)
@@ -1,6 +1,8 @@
 from vedavaapi.common.api_common import get_repo
 
 from .. import VedavaapiUllekhanam
+from ..metrics import InstrumentedCollection
+from ..query_profiler import ProfiledCollection
 
 
 def myservice():
@@ -10,7 +12,18 @@ def myservice():
 # methods acessing db
 def get_colln():
     repo_name = get_repo()
-    return myservice().colln(repo_name)
+    colln = myservice().colln(repo_name)
+    profiler = myservice().query_profiler(repo_name)
+    if profiler is not None:
+        colln = ProfiledCollection(colln, profiler)
+    if myservice().metrics is not None:
+        colln = InstrumentedCollection(colln, myservice().metrics)
+    return colln
+
+
+def root_dir_path():
+    repo_name = get_repo()
+    return myservice().root_dir_path(repo_name)
 
 
 def resource_dir_path(resource_id):
@@ -23,5 +36,82 @@ def resource_file_path(resource_id, file_path_in_resource_scope):
     return myservice().resource_file_path(repo_name, resource_id, file_path_in_resource_scope)
 
 
+def file_path(resource_id, path_in_resource_scope):
+    """
+    absolute path of a file annotation's file; resolves content addressed references too.
+    """
+    repo_name = get_repo()
+    return myservice().file_path(repo_name, resource_id, path_in_resource_scope)
+
+
+def content_store():
+    repo_name = get_repo()
+    return myservice().content_store(repo_name)
+
+
+def content_addressed_files():
+    return myservice().config.get('content_addressed_files', False)
+
+
+def fs_helper():
+    repo_name = get_repo()
+    return myservice().fs_helper(repo_name)
+
+
+def prezi_interface():
+    repo_name = get_repo()
+    return myservice().prezi_interface(repo_name)
+
+
+def write_version():
+    repo_name = get_repo()
+    return myservice().write_version(repo_name)
+
+
+def bump_write_version():
+    repo_name = get_repo()
+    return myservice().bump_write_version(repo_name)
+
+
+def index_report():
+    repo_name = get_repo()
+    return myservice().index_report(repo_name)
+
+
+def ensure_indexes():
+    repo_name = get_repo()
+    return myservice().ensure_indexes(repo_name)
+
+
+def file_delivery_config():
+    return myservice().config.get('file_delivery', {})
+
+
+def uploads_config():
+    return myservice().config.get('uploads', {})
+
+
+def job_runner():
+    return myservice().job_runner
+
+
+def api_metrics():
+    return myservice().metrics
+
+
+def query_profiler():
+    repo_name = get_repo()
+    return myservice().query_profiler(repo_name)
+
+
+def schema_payloads():
+    return myservice().schema_payloads
+
+
+def job_store():
+    repo_name = get_repo()
+    return myservice().job_store(repo_name)
+
+
 # importing blueprints
 from .v1 import api_blueprint_v1
@@ -1,7 +1,19 @@
+import base64
+import copy
+import fcntl
+import glob
+import json
 import os
 import shutil
+import time
+import uuid
+from collections import OrderedDict
 
 import sanskrit_ld.helpers.db_helper as db_helper
+from bson import ObjectId, json_util
+from flask import g, has_app_context
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError
 from sanskrit_ld.helpers.db_helper import PermissionManager
 from sanskrit_ld.schema import JsonObject
 from sanskrit_ld.schema.base import Resource, FileDescriptor
@@ -9,25 +21,125 @@ from sanskrit_ld.schema.base.annotations import FileAnnotation
 from sanskrit_ld.schema.users import User, Permission
 from werkzeug.utils import secure_filename
 
-from . import resource_file_path, resource_dir_path
+from . import resource_file_path, resource_dir_path, job_runner, job_store, fs_helper, prezi_interface, \
+    bump_write_version, content_store, content_addressed_files, root_dir_path, uploads_config
+from .. import validation
+from ..content_store import make_path_reference, parse_path_reference, path_reference_regex
+
+
+def mongo_collection(colln):
+    """
+    underlying pymongo collection of MyDbCollection. used for bulk operations, which db_helper doesn't offer.
+
+    :type colln: MyDbCollection
+    """
+    return colln.mongo_collection
+
+
+def ids_selector(ids):
+    return {"_id": {"$in": [ObjectId(_id) if ObjectId.is_valid(_id) else _id for _id in ids]}}
+
+
+class RequestCache(object):
+    """
+    memo of permission checks and resource docs read, for duration of a request.
+    so that batch operations don't repeat same checks and reads for every item.
+    """
+
+    def __init__(self):
+        # (user_id, action) -> bool
+        self.permissions = {}
+        # resource_id -> full doc
+        self.docs = {}
+
+    def forget_docs(self, resource_ids):
+        for resource_id in resource_ids:
+            self.docs.pop(resource_id, None)
+
+
+def request_cache():
+    """
+    :return: RequestCache of current request, or None, if outside of app context.
+    """
+    if not has_app_context():
+        return None
+    if 'ullekhanam_request_cache' not in g:
+        g.ullekhanam_request_cache = RequestCache()
+    return g.ullekhanam_request_cache
+
+
+def forget_resource_docs(resource_ids):
+    """
+    to be called after writing to resources, so that stale docs are not served from request cache.
+    """
+    cache = request_cache()
+    if cache is not None:
+        cache.forget_docs(resource_ids)
+
+
+def read_resource_doc(colln, resource_id):
+    """
+    db_helper.read_by_id, memoized for the request.
+    """
+    cache = request_cache()
+    if cache is None:
+        return db_helper.read_by_id(colln, resource_id)
+    if resource_id not in cache.docs:
+        cache.docs[resource_id] = db_helper.read_by_id(colln, resource_id)
+    # callers may modify doc
+    return copy.deepcopy(cache.docs[resource_id])
+
+
+def get_user_id(user):
+    return user.authentication_infos[0].user_id
 
 
 class UllekhanamPermissionManager(PermissionManager):
 
     def has_persmission(self, user, action, obj=None):
         """
+        permissions are of service level, and do not depend on obj; hence are memoized per user and action
+        for the request.
 
         :param obj:
         :param action:
         :type user: User
         :return:
         """
-        return user.check_permission('ullekhanam', action)
+        cache = request_cache()
+        if cache is None:
+            return user.check_permission('ullekhanam', action)
+        key = (get_user_id(user), action)
+        if key not in cache.permissions:
+            cache.permissions[key] = user.check_permission('ullekhanam', action)
+        return cache.permissions[key]
 
 
 permission_manager = UllekhanamPermissionManager()
 
 
+def resources_changed(resource_ids):
+    """
+    to be called by write endpoints after they create, update, or delete some of dependents of given resources,
+    so that derived data (like materialized iiif manifests, books collection, and etags) can be refreshed.
+    for deleting resources themselves, use affected_books before deletion, and books_changed after it.
+    should be called (from a finally) whenever a write was attempted, even if it failed half way,
+    as some of it may have been applied. with no resource_ids, only write version is bumped.
+    """
+    books_changed(affected_books(resource_ids) if len(resource_ids) else [])
+
+
+def affected_books(resource_ids):
+    return prezi_interface().book_ids_of(resource_ids)
+
+
+def books_changed(book_ids):
+    bump_write_version()
+    if not len(book_ids):
+        return
+    prezi_interface().books_changed(book_ids)
+
+
 def raise_if_overwrites(obj, increment, attributes):
     """
 
@@ -51,13 +163,20 @@ def delete_attributes(obj, attributes):
 
 
 # noinspection PyProtectedMember
-def handle_creation_details(colln, user, resource):
+def handle_creation_details(colln, user, resource, old_docs=None):
+    """
+
+    :param old_docs: prefetched docs of resources being updated, by id. if not given, old doc will be read from colln.
+    """
     if not isinstance(resource, Resource):
         return resource
-    user_id = user.authentication_infos[0].user_id
+    user_id = get_user_id(user)
 
     if hasattr(resource, '_id'):
-        old_object = JsonObject.make_from_dict(db_helper.read_by_id(colln, resource._id))
+        old_doc = old_docs.get(resource._id) if old_docs is not None else read_resource_doc(colln, resource._id)
+        if old_doc is None:
+            raise ValueError('resource {} does not exist'.format(resource._id))
+        old_object = JsonObject.make_from_dict(old_doc)
         raise_if_overwrites(old_object, resource, ["creator", "created"])
         # TODO modified time to be setted, contributors to be updated.
     else:
@@ -69,72 +188,836 @@ def handle_creation_details(colln, user, resource):
     return resource
 
 
-def get_associated_resource_ids(colln, resource_id, request_doc):
-    associated_res_ids = {}
-    if 'files' in request_doc:
-        files_request = request_doc['files']
-        if isinstance(files_request, bool) and files_request:
-            files_filter_doc = {}
-        else:
-            files_filter_doc = files_request
-        file_annos = db_helper.files(
-            colln, resource_id, filter_doc=files_filter_doc, fields=['_id'], return_generator=True)
-        file_anno_ids = [anno['_id'] for anno in file_annos]
-        associated_res_ids['files'] = file_anno_ids
-
-    if 'specific_resources' in request_doc:
-        sprs_request = request_doc['specific_resources']
-        if isinstance(sprs_request, bool) and sprs_request:
-            sprs_filter_doc = {}
-        else:
-            sprs_filter_doc = sprs_request
-        sprs = db_helper.specific_resources(
-            colln, resource_id, filter_doc=sprs_filter_doc, fields=['_id'], return_generator=True)
-        spr_ids = [spr['_id'] for spr in sprs]
-        associated_res_ids['specific_resources'] = spr_ids
-
-    if 'annotations' in request_doc:
-        annos_request = request_doc['annotations']
-        if isinstance(annos_request, bool) and annos_request:
-            annos_filter_doc = {}
+def read_docs_by_ids(colln, ids, fields=None):
+    """
+    reads docs of given ids with a single $in query.
+    full docs are served from, and added to request cache; only those not already read in request are queried.
+
+    :return: dict of id to doc
+    """
+    if not len(ids):
+        return {}
+    cache = request_cache() if fields is None else None
+    docs_by_id = {}
+    if cache is not None:
+        for _id in ids:
+            if cache.docs.get(_id) is not None:
+                docs_by_id[_id] = copy.deepcopy(cache.docs[_id])
+        ids = [_id for _id in ids if _id not in docs_by_id]
+        if not len(ids):
+            return docs_by_id
+    docs = db_helper.read_and_do(colln, ids_selector(ids), OrderedDict(), fields=fields, return_generator=True)
+    for doc in docs:
+        docs_by_id[str(doc['_id'])] = doc
+        if cache is not None:
+            cache.docs[str(doc['_id'])] = copy.deepcopy(doc)
+    return docs_by_id
+
+
+def _db_doc(json_map):
+    db_doc = dict(json_map)
+    if ObjectId.is_valid(db_doc['_id']):
+        db_doc['_id'] = ObjectId(db_doc['_id'])
+    return db_doc
+
+
+class BulkWriteFailure(Exception):
+    def __init__(self, msg, write_errors):
+        super(BulkWriteFailure, self).__init__(msg)
+        # list of (index, error message)
+        self.write_errors = write_errors
+
+    def to_json_map(self):
+        return {"errors": [{"index": n, "error": error} for n, error in self.write_errors]}
+
+
+def check_bulk_write_permissions(user, objects, old_docs):
+    has_new = any([obj._id not in old_docs for obj in objects])
+    has_existing = any([obj._id in old_docs for obj in objects])
+    if has_new and not permission_manager.has_persmission(user, Permission.CREATE):
+        raise PermissionError('user has no permission to create resources')
+    if has_existing and not permission_manager.has_persmission(user, Permission.UPDATE):
+        raise PermissionError('user has no permission to update resources')
+
+
+def find_orphans(colln, objects):
+    """
+    checks with one query, that resources which objects refer through target/source exist,
+    either in colln, or among objects themselves.
+
+    :return: list of (index, missing parent id) of objects which would become orphans.
+    """
+    batch_ids = set([obj._id for obj in objects])
+    links = []
+    for n, obj in enumerate(objects):
+        for link_field in ('target', 'source'):
+            link = getattr(obj, link_field, None)
+            if isinstance(link, str) and link not in batch_ids:
+                links.append((n, link))
+    if not len(links):
+        return []
+
+    existing_ids = set(read_docs_by_ids(colln, list(set([link for n, link in links])), fields=['_id']).keys())
+    return [(n, link) for n, link in links if link not in existing_ids]
+
+
+def bulk_write_objects(colln, objects, old_docs):
+    """
+    writes already validated objects, each with an _id, in one unordered bulk write.
+    objects whose ids are in old_docs are replaced, others are inserted.
+    if some writes fail, successful ones are reverted, and BulkWriteFailure is raised.
+    """
+    if not len(objects):
+        return
+    requests = []
+    for obj in objects:
+        db_doc = _db_doc(obj.to_json_map())
+        if obj._id in old_docs:
+            requests.append(ReplaceOne({"_id": db_doc['_id']}, db_doc))
         else:
-            annos_filter_doc = annos_request
-        annos = db_helper.annotations(
-            colln, resource_id, filter_doc=annos_filter_doc, fields=['_id'], return_generator=True)
-        anno_ids = [anno['_id'] for anno in annos]
-        associated_res_ids['annotations'] = anno_ids
+            requests.append(InsertOne(db_doc))
+    forget_resource_docs([obj._id for obj in objects])
+    try:
+        mongo_collection(colln).bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        write_errors = [(we['index'], we.get('errmsg')) for we in e.details.get('writeErrors', [])]
+        failed_indices = set([index for index, errmsg in write_errors])
+        revert_bulk_writes(colln, [obj for n, obj in enumerate(objects) if n not in failed_indices], old_docs)
+        raise BulkWriteFailure('bulk write failed', write_errors)
+
+
+def revert_bulk_writes(colln, objects, old_docs):
+    """
+    undoes bulk_write_objects: removes inserted objects, and restores replaced ones from old_docs.
+    """
+    raw_colln = mongo_collection(colln)
+    inserted_ids = [obj._id for obj in objects if obj._id not in old_docs]
+    if len(inserted_ids):
+        raw_colln.delete_many(ids_selector(inserted_ids))
+    restore_requests = [
+        ReplaceOne({"_id": _db_doc(old_docs[obj._id])['_id']}, _db_doc(old_docs[obj._id]))
+        for obj in objects if obj._id in old_docs]
+    if len(restore_requests):
+        raw_colln.bulk_write(restore_requests, ordered=False)
+
+
+def bulk_update_resources(colln, user, resource_docs, excluded_classes=()):
+    """
+    validates all resource_docs first, with old versions of updated ones prefetched in one query,
+    and then writes them all in single bulk write. nothing is written unless every doc is valid.
+
+    :return: (results, errors). results are per item dicts; errors is a list of (index, error) pairs,
+        and is non empty only when nothing is written.
+    """
+    old_ids = [doc['_id'] for doc in resource_docs if isinstance(doc, dict) and isinstance(doc.get('_id'), str)]
+    old_docs = read_docs_by_ids(colln, old_ids)
+
+    resources = []
+    errors = []
+    for n, doc in enumerate(resource_docs):
+        # noinspection PyBroadException
+        try:
+            resource = JsonObject.make_from_dict(doc)
+            if resource.json_class in excluded_classes:
+                raise TypeError('object type is not supported')
+            handle_creation_details(colln, user, resource, old_docs=old_docs)
+            resources.append(resource)
+        except Exception as e:
+            errors.append((n, str(e)))
+    if len(errors):
+        return [], errors
+
+    # all hydrated, and so are validated in one pass, with compiled validators
+    errors = validation.validate_many(resources)
+    if len(errors):
+        return [], errors
+    for resource in resources:
+        if not hasattr(resource, '_id'):
+            resource._id = str(ObjectId())
+
+    check_bulk_write_permissions(user, resources, old_docs)
+    orphans = find_orphans(colln, resources)
+    if len(orphans):
+        return [], [(n, 'cannot leave dependent one as an orphan; {} does not exist'.format(link))
+                    for n, link in orphans]
+
+    try:
+        bulk_write_objects(colln, resources, old_docs)
+    except BulkWriteFailure as e:
+        return [], e.write_errors
+    finally:
+        # unordered bulk writes may have been applied partially, even when failed.
+        resources_changed([resource._id for resource in resources])
+    results = []
+    for n, resource in enumerate(resources):
+        results.append({
+            "index": n,
+            "_id": resource._id,
+            "status": "updated" if resource._id in old_docs else "created",
+            "resource": resource.to_json_map()
+        })
+    return results, []
+
+
+# association kind, field linking associated resource to resource, and base selector for that kind.
+associations = (
+    ('files', 'target', {"jsonClass": "FileAnnotation"}),
+    ('specific_resources', 'source', {}),
+    ('annotations', 'target', {}),
+)
+
+
+def get_associated_resource_ids_batch(colln, resource_ids, request_doc, query_counts=None):
+    """
+    fetches associated resource ids of all given resources, with one grouped query per requested association kind.
+
+    :return: dict of resource_id to it's associated_resources doc
+    """
+    resource_ids = list(OrderedDict.fromkeys(resource_ids))
+    associated_res_ids = dict((resource_id, {}) for resource_id in resource_ids)
+
+    for association, link_field, base_selector in associations:
+        association_request = request_doc.get(association, False)
+        if association_request is False or association_request is None:
+            continue
+        filter_doc = dict(base_selector)
+        if not isinstance(association_request, bool):
+            filter_doc.update(association_request)
+
+        for resource_id in resource_ids:
+            associated_res_ids[resource_id][association] = []
+        if not len(resource_ids):
+            continue
+
+        linked_nodes = _read_linked_nodes(
+            colln, link_field, resource_ids, filter_doc=filter_doc, fields=['_id'], query_counts=query_counts)
+        for resource_id, node in linked_nodes:
+            associated_res_ids[resource_id][association].append(node['_id'])
+
     return associated_res_ids
 
 
-def attach_associated_resources(colln, resource_reprs, associated_resources_request_doc):
+def get_associated_resource_ids(colln, resource_id, request_doc):
+    return get_associated_resource_ids_batch(colln, [resource_id], request_doc)[resource_id]
+
+
+def attach_associated_resources(colln, resource_reprs, associated_resources_request_doc, query_counts=None):
+    resource_reprs = [r for r in resource_reprs if '_id' in r]
+    associated_res_ids = get_associated_resource_ids_batch(
+        colln, [r['_id'] for r in resource_reprs], associated_resources_request_doc, query_counts=query_counts)
     for resource in resource_reprs:
-        associated_resource_ids = get_associated_resource_ids(
-            colln, resource['_id'], associated_resources_request_doc
-        )
-        resource['associated_resources'] = associated_resource_ids
+        resource['associated_resources'] = associated_res_ids[resource['_id']]
 
 
-def save_file(colln, user, resource_id, file, purpose):
-    file_name = secure_filename(os.path.basename(file.filename))
-    file_path = resource_file_path(resource_id, file_name)
+def normalized_sort_spec(sort_doc):
+    """
+    sort_doc, as list of [key, direction] pairs or as a dict, to a list of (key, direction) tuples,
+    which ends with _id, so that it gives a total order.
+    """
+    if sort_doc is None:
+        sort_spec = []
+    elif isinstance(sort_doc, dict):
+        sort_spec = list(sort_doc.items())
+    else:
+        sort_spec = [tuple(item) for item in sort_doc]
+    for key, direction in sort_spec:
+        if not isinstance(key, str) or direction not in (1, -1):
+            raise ValueError('invalid sort_doc')
+    if '_id' not in [key for key, direction in sort_spec]:
+        sort_spec.append(('_id', 1))
+    return sort_spec
+
+
+def _doc_value(doc, key):
+    value = doc
+    for part in key.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def encode_continuation_token(sort_spec, last_doc):
+    # extended json, so that values like dates and ObjectIds keep their types, with type tags.
+    token_doc = {
+        "sort": sort_spec,
+        "last": [_doc_value(last_doc, key) for key, direction in sort_spec]
+    }
+    return base64.urlsafe_b64encode(json_util.dumps(token_doc).encode('utf-8')).decode('ascii')
+
+
+def decode_continuation_token(continuation_token):
+    try:
+        token_doc = json_util.loads(base64.urlsafe_b64decode(continuation_token.encode('ascii')).decode('utf-8'))
+        sort_spec = [tuple(item) for item in token_doc['sort']]
+        last_values = list(token_doc['last'])
+        # sort spec in token is used as is in query; so it should be a normalized one.
+        if normalized_sort_spec(sort_spec) != sort_spec or len(sort_spec) != len(last_values):
+            raise ValueError('invalid continuation_token')
+    except (ValueError, TypeError, KeyError):
+        raise ValueError('invalid continuation_token')
+    return sort_spec, last_values
+
+
+def _after_value_condition(key, direction, value):
+    """
+    condition for values of key coming strictly after value, in direction.
+    null and missing values sort before all others, and comparison operators never match them,
+    hence they are handled explicitly.
+
+    :return: (field, condition) to be added to selector, or None if nothing comes after.
+    """
+    if value is None:
+        if direction == 1:
+            return key, {"$ne": None}
+        return None
+    if direction == 1:
+        return key, {"$gt": value}
+    return '$or', [{key: {"$lt": value}}, {key: None}]
+
+
+def keyset_selector(sort_spec, last_values):
+    """
+    selector for docs coming strictly after last_values in sort_spec order:
+    {$or: [{k1: {$gt: v1}}, {k1: v1, k2: {$gt: v2}}, ...]}, with $lt for descending keys.
+    """
+    last_values = [
+        ObjectId(value) if key == '_id' and isinstance(value, str) and ObjectId.is_valid(value) else value
+        for (key, direction), value in zip(sort_spec, last_values)]
+    conditions = []
+    for n, (key, direction) in enumerate(sort_spec):
+        after_condition = _after_value_condition(key, direction, last_values[n])
+        if after_condition is None:
+            continue
+        # equality on null matches missing fields too, as sort treats them same.
+        condition = dict((prev_key, last_values[i]) for i, (prev_key, prev_direction) in enumerate(sort_spec[:n]))
+        condition[after_condition[0]] = after_condition[1]
+        conditions.append(condition)
+    return {"$or": conditions}
+
+
+def _copy_path(src, dst, parts):
+    key = parts[0]
+    if key not in src:
+        return
+    if len(parts) == 1:
+        dst[key] = src[key]
+        return
+    value = src[key]
+    if isinstance(value, dict):
+        sub_dst = dst.setdefault(key, {})
+        if isinstance(sub_dst, dict):
+            _copy_path(value, sub_dst, parts[1:])
+    elif isinstance(value, list):
+        existing_items = dst.get(key) if isinstance(dst.get(key), list) else []
+        items = []
+        for n, item in enumerate([item for item in value if isinstance(item, dict)]):
+            item_dst = existing_items[n] if n < len(existing_items) else {}
+            _copy_path(item, item_dst, parts[1:])
+            items.append(item_dst)
+        dst[key] = items
+
+
+def project_doc(doc, fields):
+    """
+    trims doc to given fields (dotted paths) and _id, as mongo's inclusion projection would.
+    """
+    projected = {}
+    for field in ['_id'] + list(fields):
+        _copy_path(doc, projected, field.split('.'))
+    return projected
+
+
+def read_page_by_continuation(colln, selector_doc, numbers, sort_doc=None, fields=None, continuation_token=None):
+    """
+    reads a page of resources matching selector_doc, resuming with a range query after position
+    encoded in continuation_token, instead of skipping. so every page costs same, irrespective of it's depth.
+
+    :return: (docs, next_continuation_token). next token is None, if there are no more docs.
+    """
+    if continuation_token is not None:
+        sort_spec, last_values = decode_continuation_token(continuation_token)
+        if sort_doc is not None and normalized_sort_spec(sort_doc) != sort_spec:
+            raise ValueError('sort_doc does not match with that of continuation_token')
+        selector_doc = {"$and": [selector_doc, keyset_selector(sort_spec, last_values)]}
+    else:
+        sort_spec = normalized_sort_spec(sort_doc)
+
+    requested_fields = None
+    if fields is not None:
+        def covered(key):
+            return key == '_id' or any(key == field or key.startswith(field + '.') for field in fields)
+
+        added_keys = [key for key, direction in sort_spec if not covered(key)]
+        if len(added_keys):
+            # sort keys are needed for next token; docs are trimmed back to requested fields after read.
+            requested_fields = list(fields)
+            fields = [field for field in fields if not any(field.startswith(key + '.') for key in added_keys)]
+            fields.extend(added_keys)
 
+    ops = OrderedDict([
+        ('sort', [[list(item) for item in sort_spec]]),
+        ('limit', [numbers])
+    ])
+    docs = list(db_helper.read_and_do(colln, selector_doc, ops, fields=fields, return_generator=True))
+
+    next_continuation_token = None
+    if len(docs) and len(docs) == numbers:
+        next_continuation_token = encode_continuation_token(sort_spec, docs[-1])
+    if requested_fields is not None:
+        docs = [project_doc(doc, requested_fields) for doc in docs]
+    return docs, next_continuation_token
+
+
+def iter_with_associated_resources(colln, docs, associated_resources_request_doc, chunk_size=100):
+    """
+    attaches associated resources to docs as they come from cursor, chunk by chunk,
+    so that a streamed listing still costs one grouped query per association kind per chunk.
+    """
+    chunk = []
+    for doc in docs:
+        chunk.append(doc)
+        if len(chunk) < chunk_size:
+            continue
+        attach_associated_resources(colln, chunk, associated_resources_request_doc)
+        for chunk_doc in chunk:
+            yield chunk_doc
+        chunk = []
+    if len(chunk):
+        attach_associated_resources(colln, chunk, associated_resources_request_doc)
+        for chunk_doc in chunk:
+            yield chunk_doc
+
+
+def create_file_annotation(colln, user, resource_id, file_name, purpose, path=None):
     file_descriptor = FileDescriptor.from_details(file_name)
+    if path is not None:
+        file_descriptor.path = path
     file_annotation = FileAnnotation.from_details(file_descriptor, resource_id, purpose=purpose)
     handle_creation_details(colln, user, file_annotation)
-    file_annotation.validate()
+    validation.validate(file_annotation)
     created_doc = db_helper.update(colln, file_annotation, user, permission_manager)
-    created_anno = JsonObject.make_from_dict(created_doc)
+    return JsonObject.make_from_dict(created_doc)
+
+
+def save_file(colln, user, resource_id, file, purpose):
+    file_name = secure_filename(os.path.basename(file.filename))
+    if content_addressed_files():
+        # hashed while being streamed into store; same content is stored only once.
+        digest = content_store().put_stream(file.stream)
+        try:
+            return create_file_annotation(
+                colln, user, resource_id, file_name, purpose, path=make_path_reference(digest, file_name))
+        except Exception:
+            content_store().release(digest)
+            raise
+
+    file_path = resource_file_path(resource_id, file_name)
+
+    created_anno = create_file_annotation(colln, user, resource_id, file_name, purpose)
 
     file.save(file_path)
     return created_anno
 
 
+class UploadError(Exception):
+    def __init__(self, msg, code=400):
+        super(UploadError, self).__init__(msg)
+        self.code = code
+
+
+# resumable uploads are staged in this directory, inside resource's directory.
+uploads_dir_name = '.uploads'
+
+
+def _upload_paths(upload_id):
+    resource_id, sep, session_key = upload_id.rpartition('-')
+    if not sep or not resource_id or secure_filename(upload_id) != upload_id:
+        raise UploadError('invalid upload id', code=404)
+    session_path = resource_file_path(resource_id, '{}/{}.json'.format(uploads_dir_name, session_key))
+    part_path = resource_file_path(resource_id, '{}/{}.part'.format(uploads_dir_name, session_key))
+    return resource_id, session_path, part_path
+
+
+def _read_upload_session(upload_id):
+    resource_id, session_path, part_path = _upload_paths(upload_id)
+    if not os.path.exists(session_path):
+        raise UploadError('upload session not found', code=404)
+    with open(session_path, 'r') as session_file:
+        session = json.load(session_file)
+    session['received_size'] = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    return session, part_path
+
+
+def _check_upload_permission(colln, user, resource_id):
+    if read_resource_doc(colln, resource_id) is None:
+        raise UploadError('resource not found', code=404)
+    if not permission_manager.has_persmission(user, Permission.UPDATE):
+        raise UploadError('user has no permission for this operation', code=403)
+
+
+def _read_own_upload_session(colln, user, upload_id):
+    """
+    reads upload session, if it was created by user. sessions of others are reported as not found.
+    """
+    session, part_path = _read_upload_session(upload_id)
+    if session.get('created_by') != get_user_id(user):
+        raise UploadError('upload session not found', code=404)
+    _check_upload_permission(colln, user, session['resource_id'])
+    return session, part_path
+
+
+def _lock_part_file(part_file):
+    """
+    takes exclusive lock on an open part file, so that chunks of a session are not written concurrently,
+    (by threads or by worker processes), nor while it is being finalized or aborted.
+    """
+    try:
+        fcntl.flock(part_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        raise UploadError('upload is busy with another request; retry after it completes', code=409)
+
+
+def _open_locked_part_file(part_path):
+    try:
+        part_file = open(part_path, 'r+b')
+    except FileNotFoundError:
+        raise UploadError('upload session not found', code=404)
+    try:
+        _lock_part_file(part_file)
+    except UploadError:
+        part_file.close()
+        raise
+    return part_file
+
+
+def create_upload_session(colln, user, resource_id, file_name, total_size, purpose=None):
+    """
+    starts a resumable upload of a file to resource. chunks are then written with write_upload_chunk,
+    straight into a part file inside resource's directory, and FileAnnotation is created only on finalize_upload.
+    """
+    _check_upload_permission(colln, user, resource_id)
+    file_name = secure_filename(os.path.basename(file_name))
+    if not file_name:
+        raise UploadError('invalid file name')
+    if total_size < 0:
+        raise UploadError('invalid total size')
+    schedule_upload_sessions_expiry()
+
+    upload_id = '{}-{}'.format(resource_id, uuid.uuid4().hex)
+    resource_id, session_path, part_path = _upload_paths(upload_id)
+    os.makedirs(os.path.dirname(session_path), exist_ok=True)
+    session = {
+        "upload_id": upload_id,
+        "resource_id": resource_id,
+        "file_name": file_name,
+        "total_size": total_size,
+        "purpose": purpose,
+        "created": time.time(),
+        "created_by": get_user_id(user)
+    }
+    with open(session_path, 'w') as session_file:
+        json.dump(session, session_file)
+    open(part_path, 'wb').close()
+    session['received_size'] = 0
+    return session
+
+
+def upload_status(colln, user, upload_id):
+    session, part_path = _read_own_upload_session(colln, user, upload_id)
+    return session
+
+
+def write_upload_chunk(colln, user, upload_id, offset, stream, block_size=1024 * 1024):
+    """
+    writes chunk from stream at offset of part file. offset can be at most the size received till now,
+    so that a chunk whose response was lost can be sent again.
+    offset is checked against size under lock of part file, so concurrent chunks can't interleave.
+
+    :return: upload status after writing.
+    """
+    session, part_path = _read_own_upload_session(colln, user, upload_id)
+
+    with _open_locked_part_file(part_path) as part_file:
+        received_size = os.fstat(part_file.fileno()).st_size
+        if offset < 0 or offset > received_size:
+            raise UploadError(
+                'offset should be between 0 and received size {}'.format(received_size), code=409)
+        part_file.seek(offset)
+        while True:
+            block = stream.read(block_size)
+            if not block:
+                break
+            if part_file.tell() + len(block) > session['total_size']:
+                raise UploadError('chunk goes beyond total size', code=416)
+            part_file.write(block)
+        part_file.truncate()
+        session['received_size'] = part_file.tell()
+    return session
+
+
+def finalize_upload(colln, user, upload_id):
+    """
+    moves completely received file to it's place in resource's directory, and creates FileAnnotation for it.
+    """
+    session, part_path = _read_own_upload_session(colln, user, upload_id)
+    resource_id = session['resource_id']
+
+    with _open_locked_part_file(part_path) as part_file:
+        received_size = os.fstat(part_file.fileno()).st_size
+        if received_size != session['total_size']:
+            raise UploadError('upload is incomplete; received {} of {} bytes'.format(
+                received_size, session['total_size']), code=409)
+
+        if content_addressed_files():
+            digest = content_store().put_file(part_path)
+            try:
+                created_anno = create_file_annotation(
+                    colln, user, resource_id, session['file_name'], session['purpose'],
+                    path=make_path_reference(digest, session['file_name']))
+            except Exception:
+                content_store().release(digest)
+                raise
+        else:
+            created_anno = create_file_annotation(colln, user, resource_id, session['file_name'], session['purpose'])
+            os.replace(part_path, resource_file_path(resource_id, session['file_name']))
+        abort_upload(upload_id)
+    return created_anno
+
+
+def cancel_upload(colln, user, upload_id):
+    session, part_path = _read_own_upload_session(colln, user, upload_id)
+    with _open_locked_part_file(part_path):
+        abort_upload(upload_id)
+
+
+def expire_upload_sessions(data_dir_path, max_age):
+    """
+    removes upload sessions (in .uploads directories of all resources under data_dir_path),
+    to which nothing was written since max_age seconds.
+
+    :return: number of sessions removed.
+    """
+    expired_count = 0
+    now = time.time()
+    for session_path in glob.glob(os.path.join(data_dir_path, '*', uploads_dir_name, '*.json')):
+        part_path = session_path[:-len('.json')] + '.part'
+        try:
+            last_written = max([os.path.getmtime(path) for path in (session_path, part_path) if os.path.exists(path)])
+        except (ValueError, OSError):
+            continue
+        if now - last_written < max_age:
+            continue
+        try:
+            with open(part_path, 'r+b') as part_file:
+                # sessions being written to are skipped.
+                _lock_part_file(part_file)
+                for path in (session_path, part_path):
+                    os.remove(path)
+        except FileNotFoundError:
+            if os.path.exists(session_path):
+                os.remove(session_path)
+        except UploadError:
+            continue
+        expired_count += 1
+    return expired_count
+
+
+# data dir path -> when it's expired upload sessions were last cleaned up, in this process
+_upload_sessions_cleaned = {}
+
+
+def schedule_upload_sessions_expiry():
+    """
+    submits expire_upload_sessions as a job, if it was not run in this process since cleanup_interval.
+    """
+    config = uploads_config()
+    data_dir_path = root_dir_path()
+    if time.time() - _upload_sessions_cleaned.get(data_dir_path, 0) < config.get('cleanup_interval', 3600):
+        return
+    _upload_sessions_cleaned[data_dir_path] = time.time()
+    job_runner().submit(
+        'expire_upload_sessions', expire_upload_sessions, data_dir_path, config.get('expiry_seconds', 86400))
+
+
+def release_blobs(store, digests):
+    """
+    releases one reference per given digest (a digest is to be repeated for each FileAnnotation which referred it),
+    and removes blobs no more referred since store's grace period.
+    """
+    for digest in digests:
+        store.release(digest)
+    return {"released_blobs_count": len(digests), "removed_blobs_count": store.sweep()}
+
+
+def referred_blob_digests(colln, file_anno_ids, chunk_size=10000):
+    digests = []
+    for i in range(0, len(file_anno_ids), chunk_size):
+        selector_doc = ids_selector(file_anno_ids[i:i + chunk_size])
+        selector_doc['body.path'] = {"$regex": path_reference_regex()}
+        file_annos = db_helper.read_and_do(
+            colln, selector_doc, OrderedDict(), fields=['_id', 'body.path'], return_generator=True)
+        digests.extend([parse_path_reference(anno['body']['path'])[0] for anno in file_annos])
+    return digests
+
+
+def replace_file_content(colln, file_anno, file):
+    """
+    replaces content of an existing file annotation's file with that of uploaded file.
+    content addressed files get a new blob, and old one is released.
+    """
+    blob_reference = parse_path_reference(file_anno.body.path)
+    if blob_reference is None:
+        full_path = resource_file_path(file_anno.target, file_anno.body.path)
+        os.remove(full_path)
+        file.save(full_path)
+        return
+
+    old_digest, file_name = blob_reference
+    digest = content_store().put_stream(file.stream)
+    try:
+        mongo_collection(colln).update_one(
+            ids_selector([file_anno._id]), {"$set": {"body.path": make_path_reference(digest, file_name)}})
+    except Exception:
+        content_store().release(digest)
+        raise
+    forget_resource_docs([file_anno._id])
+    release_blobs(content_store(), [old_digest])
+
+
+def abort_upload(upload_id):
+    resource_id, session_path, part_path = _upload_paths(upload_id)
+    for path in (session_path, part_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
 def delete_resource_dir(resource_id):
     res_dir_path = resource_dir_path(resource_id)
     if os.path.exists(res_dir_path):
         shutil.rmtree(res_dir_path)
 
 
+def remove_dirs(dir_paths):
+    removed_count = 0
+    for dir_path in dir_paths:
+        if os.path.exists(dir_path):
+            shutil.rmtree(dir_path, ignore_errors=True)
+            removed_count += 1
+    return {"removed_dirs_count": removed_count}
+
+
+def delete_resources_cascading(colln, user, resource_ids, chunk_size=10000):
+    """
+    deletes resources along with all their dependents (resources which target them, or are sections of them).
+    dependents are found level by level, with one query per level for all resources in that level,
+    and are then removed with delete_many, instead of one by one.
+
+    :return: (delete_report, deleted_ids, released_digests). delete_report has an entry per asked resource_id.
+        released_digests are of content addressed blobs, which deleted file annotations referred.
+    """
+    if not permission_manager.has_persmission(user, Permission.DELETE):
+        raise PermissionError('user has no permission to delete resources')
+
+    existing_ids = set(read_docs_by_ids(colln, resource_ids, fields=['_id']).keys())
+    affected_book_ids = affected_books(list(existing_ids))
+    root_of = dict((_id, _id) for _id in resource_ids if _id in existing_ids)
+    dependents_count = dict((_id, 0) for _id in root_of)
+
+    level_ids = list(root_of.keys())
+    while len(level_ids):
+        next_level_ids = []
+        for link_field in ('target', 'source'):
+            # chunked, so that $in queries of large levels stay within bson size limit.
+            for i in range(0, len(level_ids), chunk_size):
+                linked_nodes = _read_linked_nodes(colln, link_field, level_ids[i:i + chunk_size], fields=['_id'])
+                for parent_id, node in linked_nodes:
+                    if node['_id'] in root_of:
+                        continue
+                    root_of[node['_id']] = root_of[parent_id]
+                    dependents_count[root_of[parent_id]] += 1
+                    next_level_ids.append(node['_id'])
+        level_ids = next_level_ids
+
+    deleted_ids = list(root_of.keys())
+    released_digests = referred_blob_digests(colln, deleted_ids, chunk_size=chunk_size)
+    raw_colln = mongo_collection(colln)
+    try:
+        for i in range(0, len(deleted_ids), chunk_size):
+            raw_colln.delete_many(ids_selector(deleted_ids[i:i + chunk_size]))
+    finally:
+        forget_resource_docs(deleted_ids)
+        # some of them would be file annotations
+        fs_helper().invalidate(deleted_ids)
+        books_changed(affected_book_ids)
+
+    delete_report = []
+    for _id in resource_ids:
+        delete_report.append({
+            "deleted": _id in dependents_count,
+            "deleted_dependents_count": dependents_count.get(_id, 0)
+        })
+    return delete_report, deleted_ids, released_digests
+
+
+def cleanup_files(colln, store, dir_paths, released_digests):
+    result = remove_dirs(dir_paths)
+    result.update(release_blobs(store, released_digests))
+    return result
+
+
+def submit_job(name, fn, *args, **kwargs):
+    """
+    submits fn as a background job of current repo, persisted in repo's job store.
+    job runs in a copy of current request's context, hence request bound helpers can be used in it.
+    """
+    return job_runner().submit(name, fn, *args, job_store=job_store(), **kwargs)
+
+
+def submit_files_cleanup(colln, resource_ids, released_digests, submitted_by=None):
+    """
+    removes directories of given deleted resources, and blobs which are no more referred, in background,
+    and returns the job doing it.
+    """
+    dir_paths = [resource_dir_path(resource_id) for resource_id in resource_ids]
+    return submit_job(
+        'cleanup_files', cleanup_files, colln, content_store(), dir_paths, released_digests, submitted_by=submitted_by)
+
+
+def delete_resources_job(colln, user, resource_ids, progress=None):
+    """
+    cascading delete of resources, along with cleanup of their files, as a single job.
+    """
+    if progress:
+        progress(0, 2, 'deleting resources')
+    delete_report, deleted_ids, released_digests = delete_resources_cascading(colln, user, resource_ids)
+    if progress:
+        progress(1, 2, 'cleaning up files')
+    dir_paths = [resource_dir_path(resource_id) for resource_id in deleted_ids]
+    files_cleanup_result = cleanup_files(colln, content_store(), dir_paths, released_digests)
+    if progress:
+        progress(2, 2)
+    return {
+        "delete_report": delete_report,
+        "files_cleanup": files_cleanup_result
+    }
+
+
+def update_resources_job(colln, user, resource_docs, excluded_classes=(), progress=None):
+    """
+    batch update of resources as a job. as in bulk_update_resources, nothing is written if any of them is invalid.
+    result has only index, _id and status of each resource, and not resources themselves,
+    so that results of large batches stay within job's result size limit.
+    """
+    results, errors = bulk_update_resources(colln, user, resource_docs, excluded_classes=excluded_classes)
+    if len(errors):
+        raise BulkWriteFailure(
+            'batch is not applied, as some of JsonObjects are invalid or could not be written', errors)
+    if progress:
+        progress(len(resource_docs), len(resource_docs))
+    return [dict((key, result[key]) for key in ('index', '_id', 'status')) for result in results]
+
+
 # noinspection PyUnresolvedReferences
 def delete_resource_file(colln, user, file_anno_or_id):
     """
@@ -147,19 +1030,26 @@ def delete_resource_file(colln, user, file_anno_or_id):
     if isinstance(file_anno_or_id, FileAnnotation):
         file_anno = file_anno_or_id  # type: FileAnnotation
     else:
-        file_anno = JsonObject.make_from_dict(db_helper.read_by_id(colln, file_anno_or_id))  # type: FileAnnotation
+        file_anno = JsonObject.make_from_dict(read_resource_doc(colln, file_anno_or_id))  # type: FileAnnotation
 
     target_resource_id = file_anno.target
-    target_resource = JsonObject.make_from_dict(db_helper.read_by_id(colln, target_resource_id))
-
-    has_update_permission = permission_manager.has_persmission(user, Permission.UPDATE, obj=target_resource)
+    # permissions are of service level; target resource need not be read for checking them.
+    has_update_permission = permission_manager.has_persmission(user, Permission.UPDATE)
 
     if not has_update_permission:
         raise PermissionError('no permission to update resource and it\'s files')
 
     # noinspection PyProtectedMember
     colln.delete_item(file_anno._id)
+    forget_resource_docs([file_anno._id])
+    # noinspection PyProtectedMember
+    fs_helper().invalidate([file_anno._id])
+    resources_changed([target_resource_id])
     file_path_in_resource_scope = file_anno.body.path
+    blob_reference = parse_path_reference(file_path_in_resource_scope)
+    if blob_reference is not None:
+        release_blobs(content_store(), [blob_reference[0]])
+        return
     file_path = resource_file_path(target_resource_id, file_path_in_resource_scope)
     os.remove(file_path)
 
@@ -170,6 +1060,15 @@ class TreeCrawlError(Exception):
         self.tree_position = tree_position
         self.node_json = node_json
         self.error = error
+        self.succeeded_trees = []
+
+    def to_json_map(self):
+        return {
+            "error_position": self.tree_position,
+            "succeded_trees": self.succeeded_trees,
+            "error": str(self.error),
+            "node_json": self.node_json
+        }
 
 
 def update_tree(colln, user, branch, branch_path, parent_id, branch_root_node_type='root'):
@@ -177,7 +1076,13 @@ def update_tree(colln, user, branch, branch_path, parent_id, branch_root_node_ty
 
     root_node_content = branch['content']
     root_node = JsonObject.make_from_dict(root_node_content)
-    handle_creation_details(colln, user, root_node)
+    try:
+        handle_creation_details(colln, user, root_node)
+    except ValueError as e:
+        # node refers an _id, which does not exist
+        raise TreeCrawlError(
+            'content is invalid', tree_position=branch_path, node_json=root_node.to_json_map(), error=str(e)
+        )
 
     if branch_root_node_type == 'annotation':
         root_node.target = parent_id
@@ -185,8 +1090,9 @@ def update_tree(colln, user, branch, branch_path, parent_id, branch_root_node_ty
         root_node.source = parent_id
 
     try:
-        root_node.validate()
+        validation.validate(root_node)
         root_node_json = db_helper.update(colln, root_node, user, permission_manager=permission_manager)
+        forget_resource_docs([root_node_json['_id']])
         result_branch['content'] = root_node_json
     except Exception as e:
         raise TreeCrawlError(
@@ -196,7 +1102,7 @@ def update_tree(colln, user, branch, branch_path, parent_id, branch_root_node_ty
     annotation_sub_branches = branch.get('annotations', [])
     result_annotation_sub_branches = []
     for n, sb in enumerate(annotation_sub_branches):
-        sub_branch_path = branch_path+'.annotations[0]'
+        sub_branch_path = branch_path+'.annotations[{}]'.format(n)
         result_annotation_sub_branch = update_tree(
             colln, user, sb, sub_branch_path, root_node_json['_id'], branch_root_node_type='annotation')
         result_annotation_sub_branches.append(result_annotation_sub_branch)
@@ -207,7 +1113,7 @@ def update_tree(colln, user, branch, branch_path, parent_id, branch_root_node_ty
     section_sub_branches = branch.get('sections', [])
     result_section_sub_branches = []
     for n, sb in enumerate(section_sub_branches):
-        sub_branch_path = branch_path+'.sections[0]'
+        sub_branch_path = branch_path+'.sections[{}]'.format(n)
         result_section_sub_branch = update_tree(
             colln, user, sb, sub_branch_path, root_node_json['_id'], branch_root_node_type='section')
         result_section_sub_branches.append(result_section_sub_branch)
@@ -218,47 +1124,394 @@ def update_tree(colln, user, branch, branch_path, parent_id, branch_root_node_ty
     return result_branch
 
 
+class _BulkTreeNode(object):
+    def __init__(self, node, tree_position, result_branch):
+        self.node = node
+        self.tree_position = tree_position
+        self.result_branch = result_branch
+
+
+def _existing_tree_node_ids(branches):
+    ids = []
+    while len(branches):
+        sub_branches = []
+        for branch in branches:
+            content = branch.get('content')
+            if isinstance(content, dict) and isinstance(content.get('_id'), str):
+                ids.append(content['_id'])
+            sub_branches.extend(branch.get('annotations', []) + branch.get('sections', []))
+        branches = sub_branches
+    return ids
+
+
+def _prepare_tree_levels(colln, user, trees, old_docs):
+    """
+    phase one of bulk tree ingestion. hydrates and validates all nodes of all trees,
+    and pre-assigns ids to new nodes, so that children can point to their parents before anything is written.
+
+    :return: (result_trees, levels)
+    """
+    result_trees = []
+    levels = []
+
+    # (branch, tree_position, parent_id, branch_root_node_type, result_branch)
+    level_items = []
+    for i, tree in enumerate(trees):
+        result_tree = {}
+        result_trees.append(result_tree)
+        level_items.append((tree, 'tree{}'.format(i), None, 'root', result_tree))
+
+    while len(level_items):
+        level_nodes = []
+        next_level_items = []
+        for branch, tree_position, parent_id, branch_root_node_type, result_branch in level_items:
+            node = None
+            try:
+                node = JsonObject.make_from_dict(branch['content'])
+                handle_creation_details(colln, user, node, old_docs=old_docs)
+
+                if branch_root_node_type == 'annotation':
+                    node.target = parent_id
+                elif branch_root_node_type == 'section':
+                    node.source = parent_id
+
+                validation.validate(node)
+                if not hasattr(node, '_id'):
+                    node._id = str(ObjectId())
+            except Exception as e:
+                raise TreeCrawlError(
+                    'content is invalid', tree_position=tree_position,
+                    node_json=node.to_json_map() if node is not None else branch.get('content'), error=str(e)
+                )
+
+            level_nodes.append(_BulkTreeNode(node, tree_position, result_branch))
+
+            for sub_branches_key, sub_branch_type in (('annotations', 'annotation'), ('sections', 'section')):
+                sub_branches = branch.get(sub_branches_key, [])
+                if not len(sub_branches):
+                    continue
+                result_sub_branches = []
+                for n, sb in enumerate(sub_branches):
+                    result_sub_branch = {}
+                    result_sub_branches.append(result_sub_branch)
+                    next_level_items.append((
+                        sb, '{}.{}[{}]'.format(tree_position, sub_branches_key, n), node._id, sub_branch_type,
+                        result_sub_branch))
+                result_branch[sub_branches_key] = result_sub_branches
+
+        levels.append(level_nodes)
+        level_items = next_level_items
+
+    return result_trees, levels
+
+
+def bulk_update_tree(colln, user, trees, progress=None):
+    """
+    two phase bulk ingestion of trees. all nodes of all trees are validated first,
+    and then written level by level, with one unordered bulk write per level.
+    if a level's write fails, levels written till then are reverted, so that no half written tree is left.
+
+    :param progress: optional progress(done, total, message) callback, called after each level is written.
+    :return: (result_trees, timings)
+    """
+    timings = {}
+
+    phase_start = time.time()
+    old_docs = read_docs_by_ids(colln, _existing_tree_node_ids(trees))
+    result_trees, levels = _prepare_tree_levels(colln, user, trees, old_docs)
+
+    all_nodes = [level_node for level_nodes in levels for level_node in level_nodes]
+    all_objects = [level_node.node for level_node in all_nodes]
+    check_bulk_write_permissions(user, all_objects, old_docs)
+    orphans = find_orphans(colln, all_objects)
+    if len(orphans):
+        n, missing_id = orphans[0]
+        raise TreeCrawlError(
+            'cannot leave dependent one as an orphan', tree_position=all_nodes[n].tree_position,
+            node_json=all_objects[n].to_json_map(), error='resource {} does not exist'.format(missing_id))
+    timings['validation'] = time.time() - phase_start
+
+    phase_start = time.time()
+    timings['levels'] = []
+    written_objects = []
+    try:
+        for level_nodes in levels:
+            level_start = time.time()
+            level_objects = [level_node.node for level_node in level_nodes]
+            try:
+                bulk_write_objects(colln, level_objects, old_docs)
+            except BulkWriteFailure as e:
+                revert_bulk_writes(colln, written_objects, old_docs)
+                index, errmsg = e.write_errors[0]
+                raise TreeCrawlError(
+                    'content could not be written', tree_position=level_nodes[index].tree_position,
+                    node_json=level_objects[index].to_json_map(), error=errmsg)
+            written_objects.extend(level_objects)
+            for level_node in level_nodes:
+                level_node.result_branch['content'] = level_node.node.to_json_map()
+            timings['levels'].append({"nodes": len(level_nodes), "seconds": time.time() - level_start})
+            if progress:
+                progress(len(written_objects), len(all_objects), 'nodes written')
+    finally:
+        # even failed levels (and their reverts) may have been partially applied.
+        resources_changed([level_node.node._id for level_node in levels[0]] if len(levels) else [])
+    timings['writes'] = time.time() - phase_start
+    return result_trees, timings
+
+
+def update_trees(colln, user, trees, progress=None):
+    """
+    writes trees one after other. if a tree could not be crawled, raises TreeCrawlError,
+    with trees written till then as it's succeeded_trees.
+    """
+    result_trees = []
+    for i, tree in enumerate(trees):
+        result_tree = None
+        try:
+            # noinspection PyTypeChecker
+            result_tree = update_tree(colln, user, tree, 'tree{}'.format(i), None)
+        except TreeCrawlError as e:
+            e.succeeded_trees = result_trees
+            raise e
+        finally:
+            # nodes of a tree, which failed half way, are left written.
+            if result_tree is not None:
+                root_id = result_tree['content']['_id']
+            else:
+                tree_content = tree.get('content') if isinstance(tree, dict) else None
+                root_id = tree_content.get('_id') if isinstance(tree_content, dict) else None
+            resources_changed([root_id] if root_id is not None else [])
+        result_trees.append(result_tree)
+        if progress:
+            progress(i + 1, len(trees), 'trees written')
+    return result_trees
+
+
+def update_trees_job(colln, user, trees, bulk=False, progress=None):
+    if bulk:
+        result_trees, timings = bulk_update_tree(colln, user, trees, progress=progress)
+        return {
+            "trees": result_trees,
+            "timings": timings
+        }
+    return update_trees(colln, user, trees, progress=progress)
+
+
+# operations which can be submitted as jobs through jobs api, with their allowed params.
+job_operations = {
+    "update_trees": (update_trees_job, ('trees', 'bulk')),
+    "update_resources": (update_resources_job, ('resource_docs',)),
+    "delete_resources": (delete_resources_job, ('resource_ids',))
+}
+
+
+def _read_linked_nodes(
+        colln, link_field, parent_ids, filter_doc=None, fields=None, query_counts=None, sort_by_id=False):
+    """
+    reads all nodes linked to any of parent_ids through link_field ('source' for sections, 'target' for annotations),
+    with a single $in query.
+
+    :return: generator of (parent_id, node) pairs
+    """
+    selector_doc = dict(filter_doc or {})
+    selector_doc[link_field] = {"$in": list(parent_ids)}
+
+    strip_link_field = False
+    if fields is not None:
+        fields = list(fields)
+        if '_id' not in fields:
+            fields.append('_id')
+        if link_field not in fields:
+            fields.append(link_field)
+            strip_link_field = True
+
+    if query_counts is not None:
+        query_counts['total'] = query_counts.get('total', 0) + 1
+
+    ops = OrderedDict()
+    if sort_by_id:
+        ops['sort'] = [[['_id', 1]]]
+
+    parent_ids_set = set(parent_ids)
+    nodes = db_helper.read_and_do(colln, selector_doc, ops, fields=fields, return_generator=True)
+    for node in nodes:
+        links = node.get(link_field)
+        links = links if isinstance(links, list) else [links]
+        if strip_link_field:
+            node.pop(link_field, None)
+        for link in links:
+            if link in parent_ids_set:
+                yield link, node
+
+
 def read_tree(
         colln, root_node, max_depth,
         specific_resource_filter=None, annotation_filter=None,
-        specific_resource_fields=None, annotation_fields=None):
+        specific_resource_fields=None, annotation_fields=None,
+        associated_resources_request_doc=None, query_counts=None):
+    """
+    reads tree rooted at root_node, level by level.
+    each depth level costs one query for sections and one for annotations of all the nodes in that level,
+    irrespective of how many nodes are there in it.
+
+    :param associated_resources_request_doc: if given, associated resource ids are attached to nodes,
+        again with grouped queries per level.
+    :param query_counts: if a dict is passed, total number of queries and queries per level will be recorded into it.
+    """
     tree = {
         "content": root_node
     }
-    if specific_resource_fields is not None and '_id' not in specific_resource_fields:
-        specific_resource_fields.append('_id')
-
-    specific_resources = db_helper.specific_resources(
-        colln, root_node['_id'], filter_doc=specific_resource_filter, fields=specific_resource_fields)
-
-    specific_resource_sub_branches = []
-    for spr in specific_resources:
-        sub_branch = read_tree(
-            colln, spr, max_depth-1,
-            specific_resource_filter=specific_resource_filter,
-            annotation_filter=annotation_filter,
-            specific_resource_fields=specific_resource_fields,
-            annotation_fields=annotation_fields
-        )
-        specific_resource_sub_branches.append(sub_branch)
-
-    if annotation_fields is not None and '_id' not in annotation_fields:
-        annotation_fields.append('_id')
-
-    annotations = db_helper.annotations(
-        colln, root_node['_id'], filter_doc=annotation_filter, fields=annotation_fields)
-
-    annotation_sub_branches = []
-    for anno in annotations:
-        sub_branch = read_tree(
-            colln, anno, max_depth-1,
-            specific_resource_filter=specific_resource_filter,
-            annotation_filter=annotation_filter,
-            specific_resource_fields=specific_resource_fields,
-            annotation_fields=annotation_fields
-        )
-        annotation_sub_branches.append(sub_branch)
+    if query_counts is not None:
+        query_counts.setdefault('total', 0)
+        query_counts.setdefault('per_level', [])
 
-    tree['sections'] = specific_resource_sub_branches
-    tree['annotations'] = annotation_sub_branches
+    level_branches = [tree]
+    for depth in range(max_depth):
+        if not len(level_branches):
+            break
+        branches_by_id = {}
+        for branch in level_branches:
+            branch['sections'] = []
+            branch['annotations'] = []
+            branches_by_id.setdefault(branch['content']['_id'], []).append(branch)
+
+        queries_before = query_counts['total'] if query_counts is not None else 0
+        if associated_resources_request_doc is not None:
+            attach_associated_resources(
+                colln, [branch['content'] for branch in level_branches], associated_resources_request_doc,
+                query_counts=query_counts)
+        next_level_branches = []
+        for sub_branches_key, link_field, filter_doc, fields in (
+                ('sections', 'source', specific_resource_filter, specific_resource_fields),
+                ('annotations', 'target', annotation_filter, annotation_fields)):
+            linked_nodes = _read_linked_nodes(
+                colln, link_field, list(branches_by_id.keys()),
+                filter_doc=filter_doc, fields=fields, query_counts=query_counts)
+            for parent_id, node in linked_nodes:
+                for parent_branch in branches_by_id[parent_id]:
+                    sub_branch = {"content": node}
+                    parent_branch[sub_branches_key].append(sub_branch)
+                    next_level_branches.append(sub_branch)
+
+        if query_counts is not None:
+            query_counts['per_level'].append(query_counts['total'] - queries_before)
+        level_branches = next_level_branches
+
+    if associated_resources_request_doc is not None and len(level_branches):
+        # nodes at max_depth are not expanded, but still should carry associated resources
+        attach_associated_resources(
+            colln, [branch['content'] for branch in level_branches], associated_resources_request_doc,
+            query_counts=query_counts)
     return tree
+
+
+class TreeResumeError(Exception):
+    def __init__(self, msg, code=400):
+        super(TreeResumeError, self).__init__(msg)
+        self.code = code
+
+
+def tree_resume_point(colln, root_id, resume_after, max_depth):
+    """
+    locates node resume_after in tree rooted at root_id, by walking up it's source/target links.
+
+    :return: (depth, relation) of the node; relation is None for root itself.
+    :raises TreeResumeError: if resume_after is not a valid id (400), if node does not exist (404),
+        or is not a node of this tree within max_depth (400).
+    """
+    if resume_after == root_id:
+        return 0, None
+    # resources are stored with ObjectIds; read_by_id would fail on anything else.
+    if not ObjectId.is_valid(resume_after):
+        raise TreeResumeError('resume_after {} is not a valid resource id'.format(resume_after))
+    node = db_helper.read_by_id(colln, resume_after)
+    if node is None:
+        raise TreeResumeError('resume_after node {} does not exist'.format(resume_after), code=404)
+
+    # (ancestor, relation of resume node to it's parent on path to this ancestor)
+    level = [(node, None)]
+    for depth in range(1, max_depth + 1):
+        parents = OrderedDict()
+        for level_node, relation in level:
+            for link_relation, link_field in (('sections', 'source'), ('annotations', 'target')):
+                links = level_node.get(link_field)
+                for link in (links if isinstance(links, list) else [links]):
+                    if not isinstance(link, str):
+                        continue
+                    if link == root_id:
+                        return depth, relation or link_relation
+                    parents.setdefault(link, relation or link_relation)
+        if not len(parents):
+            break
+        parent_docs = read_docs_by_ids(colln, list(parents.keys()), fields=['_id', 'source', 'target'])
+        level = [(parent_docs[_id], relation) for _id, relation in parents.items() if _id in parent_docs]
+    raise TreeResumeError('resume_after node {} is not in this tree, within max_depth'.format(resume_after))
+
+
+def _with_id_condition(filter_doc, id_condition):
+    filter_doc = dict(filter_doc or {})
+    if '_id' in filter_doc:
+        return {"$and": [filter_doc, {"_id": id_condition}]}
+    filter_doc['_id'] = id_condition
+    return filter_doc
+
+
+def iter_tree_nodes(
+        colln, root_node, max_depth,
+        specific_resource_filter=None, annotation_filter=None,
+        specific_resource_fields=None, annotation_fields=None, resume_after=None, resume_point=None):
+    """
+    yields nodes of tree rooted at root_node one at a time, level by level, in flat parent-pointer form::
+
+        {"_id": ..., "parent": ..., "relation": "sections"|"annotations"|null, "depth": ..., "content": ...}
+
+    only ids of current level are held in memory. nodes of a level are ordered by _id within each relation,
+    so order is stable across calls, and an export can be resumed with resume_after,
+    which is the _id of last node client received.
+    on resume, levels above resume node's level, and nodes of it's level till resume node, are read as ids only;
+    contents are read only from resume point onwards.
+
+    :param resume_point: (depth, relation) of resume_after, as given by tree_resume_point.
+        computed here if not given; callers which want to report a bad resume_after before streaming
+        should compute it themselves.
+    """
+    root_id = root_node['_id']
+    relations = (
+        ('sections', 'source', specific_resource_filter, specific_resource_fields),
+        ('annotations', 'target', annotation_filter, annotation_fields))
+
+    resume_depth, resume_index, resume_oid = -1, -1, None
+    if resume_after is None:
+        yield {"_id": root_id, "parent": None, "relation": None, "depth": 0, "content": root_node}
+    else:
+        if resume_point is None:
+            resume_point = tree_resume_point(colln, root_id, resume_after, max_depth)
+        resume_depth, resume_relation = resume_point
+        if resume_relation is not None:
+            resume_index = [relation[0] for relation in relations].index(resume_relation)
+        resume_oid = ObjectId(resume_after) if ObjectId.is_valid(resume_after) else resume_after
+
+    level_ids = [root_id]
+    for depth in range(1, max_depth + 1):
+        if not len(level_ids):
+            break
+        next_level_ids = []
+        for n, (relation, link_field, filter_doc, fields) in enumerate(relations):
+            if depth < resume_depth or (depth == resume_depth and n < resume_index):
+                # before resume point; only ids are needed, for next level.
+                id_nodes = _read_linked_nodes(colln, link_field, level_ids, filter_doc=filter_doc, fields=['_id'])
+                next_level_ids.extend([node['_id'] for parent_id, node in id_nodes])
+                continue
+            if depth == resume_depth and n == resume_index:
+                id_nodes = _read_linked_nodes(
+                    colln, link_field, level_ids, filter_doc=_with_id_condition(filter_doc, {"$lte": resume_oid}),
+                    fields=['_id'], sort_by_id=True)
+                next_level_ids.extend([node['_id'] for parent_id, node in id_nodes])
+                filter_doc = _with_id_condition(filter_doc, {"$gt": resume_oid})
+
+            linked_nodes = _read_linked_nodes(
+                colln, link_field, level_ids, filter_doc=filter_doc, fields=fields, sort_by_id=True)
+            for parent_id, node in linked_nodes:
+                next_level_ids.append(node['_id'])
+                yield {"_id": node['_id'], "parent": parent_id, "relation": relation, "depth": depth, "content": node}
+        level_ids = list(OrderedDict.fromkeys(next_level_ids))
@@ -1,5 +1,5 @@
 import flask_restplus
-from flask import Blueprint
+from flask import Blueprint, request
 from .. import myservice
 
 api_blueprint_v1 = Blueprint(myservice().name + '_v1', __name__)
@@ -27,4 +27,19 @@ api = flask_restplus.Api(
     doc='/v1'
 )
 
+
+@api_blueprint_v1.before_request
+def start_request_metrics():
+    if myservice().metrics is not None:
+        myservice().metrics.request_started()
+
+
+@api_blueprint_v1.after_request
+def record_request_metrics(response):
+    if myservice().metrics is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        myservice().metrics.request_finished(route, request.method, response)
+    return response
+
+
 from . import rest
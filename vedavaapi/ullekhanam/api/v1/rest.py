@@ -1,19 +1,26 @@
-# import json
+import hashlib
+import itertools
+import json
+import mimetypes
 # import os
 from collections import OrderedDict
+from urllib.parse import quote
 
 import flask_restplus
-from flask import request
+from flask import request, Response, stream_with_context, send_file
 # from sanskrit_ld.helpers import db_helper
 from sanskrit_ld.helpers.validation_helper import OrphanResourceError
 # from sanskrit_ld.schema import JsonObject
 # from sanskrit_ld.schema.users import Permission
-from vedavaapi.common.api_common import jsonify_argument, error_response, get_user, check_argument_type
+from vedavaapi.common.api_common import jsonify_argument, error_response, get_user, check_argument_type, get_repo
 from werkzeug.datastructures import FileStorage
+from werkzeug.http import parse_content_range_header
 
 from . import api
-from .. import get_colln
+from .. import get_colln, job_runner, job_store, schema_payloads, api_metrics, query_profiler, index_report, \
+    ensure_indexes, fs_helper, prezi_interface, write_version, root_dir_path, file_delivery_config
 from ..helper import *
+from ... import validation
 
 # GET: /resources; selector_doc, start, len, sort DONE
 # POST: /resources; entity or resources_array, files DONE
@@ -35,6 +42,134 @@ from ..helper import *
 
 permission_manager = UllekhanamPermissionManager()
 
+response_formats = ('json', 'json_stream', 'ndjson')
+
+
+def streamed_docs_response(docs, response_format):
+    """
+    writes docs to response as cursor yields them, either as a json array (json_stream),
+    or as newline delimited json (ndjson), instead of materializing whole listing first.
+    """
+    def generate_ndjson():
+        for doc in docs:
+            yield json.dumps(doc) + '\n'
+
+    def generate_json_array():
+        yield '['
+        for n, doc in enumerate(docs):
+            yield (',' if n else '') + json.dumps(doc)
+        yield ']'
+
+    if response_format == 'ndjson':
+        return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+    return Response(stream_with_context(generate_json_array()), mimetype='application/json')
+
+
+def versioned_etag():
+    """
+    strong etag for current request, derived from repo's write version, which changes with every write.
+    """
+    etag_basis = '{}:{}:{}'.format(get_repo(), write_version(), request.full_path)
+    return hashlib.sha1(etag_basis.encode('utf-8')).hexdigest()
+
+
+def conditional_response(etag, build_body):
+    """
+    responds with 304 without building body, if client already has representation with given etag.
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    body = build_body()
+    if not isinstance(body, (dict, list)):
+        # error responses
+        return body
+    response = api.make_response(body, 200)
+    response.set_etag(etag)
+    return response
+
+
+def payload_response(payload):
+    """
+    responds with a pre-encoded payload, gzipped if client accepts it, with conditional request support.
+    """
+    if request.if_none_match.contains(payload.etag):
+        response = Response(status=304)
+    elif 'gzip' in request.accept_encodings:
+        response = Response(payload.gzipped, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(payload.raw, mimetype='application/json')
+    response.set_etag(payload.etag)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def file_response(abs_file_path, file_name=None):
+    """
+    responds with file, as per file_delivery config, once authorization and path resolution are done.
+    file_name (as uploaded) is used for mimetype and download name, as stored path may not have it (blobs).
+
+    modes:
+        direct: served by app, with conditional and Range (partial content) support.
+            when wsgi server offers wsgi.file_wrapper (like gunicorn), whole file responses go through sendfile.
+        x_accel_redirect: only headers are sent, and nginx serves bytes from internal location
+            x_accel_redirect_prefix, which should alias x_accel_redirect_root directory
+            (repo's root data directory by default).
+        x_sendfile: only headers are sent, with X-Sendfile header for apache/lighttpd.
+
+    content of a file url can be replaced, so responses are not to be reused without revalidation (no-cache).
+    they carry an etag of file's version, so that revalidation is a cheap 304.
+    """
+    delivery_config = file_delivery_config()
+    mode = delivery_config.get('mode', 'direct')
+    mimetype = mimetypes.guess_type(file_name or abs_file_path)[0] or 'application/octet-stream'
+
+    if mode in ('x_accel_redirect', 'x_sendfile'):
+        # send_file computes it's own etag in direct mode.
+        file_stat = os.stat(abs_file_path)
+        etag = hashlib.sha1('{}:{}:{}:{}'.format(
+            abs_file_path, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns).encode('utf-8')).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.cache_control.no_cache = True
+            return response
+
+    if mode == 'x_accel_redirect':
+        relative_path = os.path.relpath(abs_file_path, delivery_config.get('x_accel_redirect_root', root_dir_path()))
+        prefix = delivery_config.get('x_accel_redirect_prefix', '/ullekhanam_files/')
+        response = Response(status=200, mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = '{}/{}'.format(
+            prefix.rstrip('/'), quote(relative_path.replace(os.sep, '/')))
+    elif mode == 'x_sendfile':
+        response = Response(status=200, mimetype=mimetype)
+        response.headers['X-Sendfile'] = abs_file_path
+    else:
+        response = send_file(abs_file_path, mimetype=mimetype, conditional=True)
+    if mode in ('x_accel_redirect', 'x_sendfile'):
+        response.set_etag(etag)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if file_name:
+        response.headers['Content-Disposition'] = "inline; filename*=UTF-8''{}".format(quote(file_name))
+    # send_file sets a max_age of it's own.
+    response.cache_control.max_age = None
+    response.cache_control.no_cache = True
+    return response
+
+
+def primed(docs):
+    """
+    pulls first doc out of generator, so that errors in query surface before response starts streaming.
+    """
+    docs = iter(docs)
+    try:
+        first_doc = next(docs)
+    except StopIteration:
+        return iter([])
+    return itertools.chain([first_doc], docs)
+
 
 @api.route('/resources')
 class Resources(flask_restplus.Resource):
@@ -45,17 +180,23 @@ class Resources(flask_restplus.Resource):
     get_parser.add_argument('selector_doc', location='args', type=str, required=True)
     get_parser.add_argument('fields', location='args', type=str)
     get_parser.add_argument('associated_resources', location='args', type=str)
-    get_parser.add_argument('start', location='args', type=int, required=True)
+    get_parser.add_argument('start', location='args', type=int, default=0)
     get_parser.add_argument('numbers', location='args', type=int, required=True)
     get_parser.add_argument('sort_doc', location='args', type=str)
+    get_parser.add_argument('use_continuation', location='args', type=flask_restplus.inputs.boolean, default=False)
+    get_parser.add_argument('continuation_token', location='args', type=str)
+    get_parser.add_argument('response_format', location='args', type=str, choices=response_formats, default='json')
 
     post_parser = api.parser()
     post_parser.add_argument('resource_json', location='form', type=str, required=True)
     post_parser.add_argument('files', type=FileStorage, location='files')
     post_parser.add_argument('files_purpose', type=str, location='form')
+    post_parser.add_argument('batch', type=flask_restplus.inputs.boolean, location='form', default=False)
+    post_parser.add_argument('async', type=flask_restplus.inputs.boolean, location='form', default=False)
 
     delete_parser = api.parser()
     delete_parser.add_argument('resource_ids', location='form', type=str, required=True)
+    delete_parser.add_argument('async', type=flask_restplus.inputs.boolean, location='form', default=False)
 
     @api.expect(get_parser, validate=True)
     def get(self):
@@ -74,12 +215,42 @@ class Resources(flask_restplus.Resource):
         sort_doc = jsonify_argument(args['sort_doc'], key='sort_doc')
         check_argument_type(sort_doc, (dict, list), key='sort_doc', allow_none=True)
 
+        if args['use_continuation'] or args['continuation_token'] is not None:
+            # resumes with a range query after last sort key and _id of previous page, instead of skip.
+            if args['response_format'] != 'json':
+                return error_response(
+                    message='response_format is not supported with continuation; pages are returned as json',
+                    code=400)
+            try:
+                resource_reprs, next_continuation_token = read_page_by_continuation(
+                    colln, selector_doc, args['numbers'], sort_doc=sort_doc, fields=fields,
+                    continuation_token=args['continuation_token'])
+            except (TypeError, ValueError) as e:
+                return error_response(message='arguments to operations seems invalid', code=400, error=str(e))
+            if associated_resources_request_doc is not None:
+                attach_associated_resources(colln, resource_reprs, associated_resources_request_doc)
+            return {
+                "items": resource_reprs,
+                "continuation_token": next_continuation_token
+            }
+
         ops = OrderedDict()
         if sort_doc is not None:
             ops['sort'] = [sort_doc]
         ops['skip'] = [args['start']]
         ops['limit'] = [args['numbers']]
 
+        if args['response_format'] != 'json':
+            try:
+                resource_reprs = primed(db_helper.read_and_do(
+                    colln, selector_doc, ops, fields=fields, return_generator=True))
+            except (TypeError, ValueError):
+                return error_response(message='arguments to operations seems invalid', code=400)
+            if associated_resources_request_doc is not None:
+                resource_reprs = iter_with_associated_resources(
+                    colln, resource_reprs, associated_resources_request_doc)
+            return streamed_docs_response(resource_reprs, args['response_format'])
+
         try:
             resource_reprs = list(db_helper.read_and_do(colln, selector_doc, ops, fields=fields, return_generator=True))
         except (TypeError, ValueError):
@@ -101,37 +272,67 @@ class Resources(flask_restplus.Resource):
 
         resource_docs = resource_doc if isinstance(resource_doc, list) else [resource_doc]
 
+        if args['async'] and not (args['batch'] and isinstance(resource_doc, list)):
+            return error_response(
+                message='async is supported only for batch=true, with a list of JsonObjects', code=400)
+
+        if args['batch'] and isinstance(resource_doc, list):
+            if args['async']:
+                job = submit_job(
+                    'update_resources', update_resources_job, colln, user, resource_docs,
+                    excluded_classes=self.white_listed_classes, with_progress=True, submitted_by=get_user_id(user))
+                return job.to_json_map(), 202
+            try:
+                results, errors = bulk_update_resources(
+                    colln, user, resource_docs, excluded_classes=self.white_listed_classes)
+            except PermissionError as e:
+                return error_response(message=str(e), code=403)
+            if len(errors):
+                return error_response(
+                    message='batch is not applied, as some of JsonObjects are invalid or could not be written',
+                    code=404, errors=[{"index": n, "error": error} for n, error in errors]
+                )
+            return results
+
         '''
         TODO thought: can check integrity of all resources first,
         and then after ensuring all has integrity, we can proceed.
         instead of deleting some, and then halt at some
         '''
 
-        for n, doc in enumerate(resource_docs):
-            # noinspection PyBroadException
-            try:
-                resource = JsonObject.make_from_dict(doc)
-                if resource.json_class in self.white_listed_classes:
-                    raise TypeError('object type is not supported')
-                handle_creation_details(colln, user, resource)
-                resource.validate()
-            except Exception as e:
-                return error_response(
-                    message='{} th JsonObject\'s schema is invalid'.format(n),
-                    code=404, posted=created_docs, errorAt=n, error=str(e)
-                )
-            try:
-                created_doc = db_helper.update(colln, resource, user, permission_manager=permission_manager)
-                created_docs.append(created_doc)
-            except OrphanResourceError:
-                return error_response(message="cannot leave dependent one as an orphan", code=404)
-
-        if isinstance(resource_doc, dict):
-            resource_id = created_docs[0]['_id']
-            files = request.files.getlist("files")
-            purpose = args['files_purpose']
-            for f in files:
-                save_file(colln, user, resource_id, f, purpose)
+        write_attempted = False
+        try:
+            for n, doc in enumerate(resource_docs):
+                # noinspection PyBroadException
+                try:
+                    resource = JsonObject.make_from_dict(doc)
+                    if resource.json_class in self.white_listed_classes:
+                        raise TypeError('object type is not supported')
+                    handle_creation_details(colln, user, resource)
+                    validation.validate(resource)
+                except Exception as e:
+                    return error_response(
+                        message='{} th JsonObject\'s schema is invalid'.format(n),
+                        code=404, posted=created_docs, errorAt=n, error=str(e)
+                    )
+                write_attempted = True
+                try:
+                    created_doc = db_helper.update(colln, resource, user, permission_manager=permission_manager)
+                    forget_resource_docs([created_doc['_id']])
+                    created_docs.append(created_doc)
+                except OrphanResourceError:
+                    return error_response(message="cannot leave dependent one as an orphan", code=404)
+
+            if isinstance(resource_doc, dict):
+                resource_id = created_docs[0]['_id']
+                files = request.files.getlist("files")
+                purpose = args['files_purpose']
+                for f in files:
+                    save_file(colln, user, resource_id, f, purpose)
+        finally:
+            # docs written before a failure stay written.
+            if write_attempted:
+                resources_changed([doc['_id'] for doc in created_docs])
         return created_docs
 
     @api.expect(delete_parser, validate=True)
@@ -147,18 +348,22 @@ class Resources(flask_restplus.Resource):
         if not ids_validity:
             return error_response(message='ids should be strings', code=404)
 
-        delete_report = []
+        if args['async']:
+            job = submit_job(
+                'delete_resources', delete_resources_job, colln, user, resource_ids,
+                with_progress=True, submitted_by=get_user_id(user))
+            return job.to_json_map(), 202
 
-        for _id in resource_ids:
-            deleted, deleted_res_ids = db_helper.delete(colln, _id, user, permission_manager=permission_manager)
-            for deleted_res_id in deleted_res_ids:
-                delete_resource_dir(deleted_res_id)
-            delete_report.append({
-                "deleted": deleted,
-                "deleted_dependents_count": len(deleted_res_ids)
-            })
+        try:
+            delete_report, deleted_ids, released_digests = delete_resources_cascading(colln, user, resource_ids)
+        except PermissionError:
+            return error_response(message="user has no permission for this operation", code=403)
 
-        return delete_report
+        cleanup_job = submit_files_cleanup(colln, deleted_ids, released_digests, submitted_by=get_user_id(user))
+        return {
+            "delete_report": delete_report,
+            "files_cleanup_job": cleanup_job.to_json_map()
+        }
 
 
 # noinspection PyMethodMayBeStatic
@@ -176,13 +381,16 @@ class ResourceObject(flask_restplus.Resource):
         associated_resources_request_doc = jsonify_argument(args['associated_resources'], 'associated_resources')
         check_argument_type(associated_resources_request_doc, (dict,), key='associated_resources', allow_none=True)
 
-        resource = db_helper.read_by_id(colln, resource_id)
-        if resource is None:
-            return error_response(message="resource not found", code=404)
+        def build_body():
+            resource = db_helper.read_by_id(colln, resource_id)
+            if resource is None:
+                return error_response(message="resource not found", code=404)
 
-        if associated_resources_request_doc is not None:
-            attach_associated_resources(colln, [resource], associated_resources_request_doc)
-        return resource
+            if associated_resources_request_doc is not None:
+                attach_associated_resources(colln, [resource], associated_resources_request_doc)
+            return resource
+
+        return conditional_response(versioned_etag(), build_body)
 
 
 @api.route('/resources/<string:resource_id>/sections')
@@ -192,6 +400,7 @@ class SpecificResources(flask_restplus.Resource):
     get_parser.add_argument('filter_doc', location='args', type=str)
     get_parser.add_argument('fields', location='args', type=str)
     get_parser.add_argument('associated_resources', location='args', type=str)
+    get_parser.add_argument('response_format', location='args', type=str, choices=response_formats, default='json')
 
     delete_parser = api.parser()
     delete_parser.add_argument('filter_doc', location='form', type=str)
@@ -210,6 +419,14 @@ class SpecificResources(flask_restplus.Resource):
         associated_resources_request_doc = jsonify_argument(args['associated_resources'], 'associated_resources')
         check_argument_type(associated_resources_request_doc, (dict,), key='associated_resources', allow_none=True)
 
+        if args['response_format'] != 'json':
+            specific_resources = db_helper.specific_resources(
+                colln, resource_id, filter_doc=filter_doc, fields=fields, return_generator=True)
+            if associated_resources_request_doc is not None:
+                specific_resources = iter_with_associated_resources(
+                    colln, specific_resources, associated_resources_request_doc)
+            return streamed_docs_response(specific_resources, args['response_format'])
+
         specific_resources = list(db_helper.specific_resources(
             colln, resource_id, filter_doc=filter_doc, fields=fields, return_generator=True
         ))
@@ -226,9 +443,12 @@ class SpecificResources(flask_restplus.Resource):
         filter_doc = jsonify_argument(args['filter_doc'], key='filter_doc') or {}
         check_argument_type(filter_doc, (dict,), key='filter_doc')
 
-        deleted_all, deleted_res_ids = db_helper.delete_specific_resources(
-            colln, resource_id, user, filter_doc=filter_doc, permission_manager=permission_manager
-        )
+        try:
+            deleted_all, deleted_res_ids = db_helper.delete_specific_resources(
+                colln, resource_id, user, filter_doc=filter_doc, permission_manager=permission_manager
+            )
+        finally:
+            resources_changed([resource_id])
         return {
             "deleted_all": deleted_all,
             "deleted_res_ids": deleted_res_ids
@@ -242,6 +462,7 @@ class Annotations(flask_restplus.Resource):
     get_parser.add_argument('filter_doc', location='args', type=str)
     get_parser.add_argument('fields', location='args', type=str)
     get_parser.add_argument('associated_resources', location='args', type=str)
+    get_parser.add_argument('response_format', location='args', type=str, choices=response_formats, default='json')
 
     delete_parser = api.parser()
     delete_parser.add_argument('filter_doc', location='form', type=str)
@@ -260,6 +481,13 @@ class Annotations(flask_restplus.Resource):
         associated_resources_request_doc = jsonify_argument(args['associated_resources'], 'associated_resources')
         check_argument_type(associated_resources_request_doc, (dict,), key='associated_resources', allow_none=True)
 
+        if args['response_format'] != 'json':
+            annotations = db_helper.annotations(
+                colln, resource_id, filter_doc=filter_doc, fields=fields, return_generator=True)
+            if associated_resources_request_doc is not None:
+                annotations = iter_with_associated_resources(colln, annotations, associated_resources_request_doc)
+            return streamed_docs_response(annotations, args['response_format'])
+
         annotations = list(db_helper.annotations(
             colln, resource_id, filter_doc=filter_doc, fields=fields, return_generator=True
         ))
@@ -276,9 +504,12 @@ class Annotations(flask_restplus.Resource):
         filter_doc = jsonify_argument(args['filter_doc'], key='filter_doc') or {}
         check_argument_type(filter_doc, (dict,), key='filter_doc')
 
-        deleted_all, deleted_res_ids = db_helper.delete_annotations(
-            colln, resource_id, user, filter_doc=filter_doc, permission_manager=permission_manager
-        )
+        try:
+            deleted_all, deleted_res_ids = db_helper.delete_annotations(
+                colln, resource_id, user, filter_doc=filter_doc, permission_manager=permission_manager
+            )
+        finally:
+            resources_changed([resource_id])
         return {
             "deleted_all": deleted_all,
             "deleted_res_ids": deleted_res_ids
@@ -317,13 +548,103 @@ class Files(flask_restplus.Resource):
         files = request.files.getlist("files")
         purpose = args['files_purpose']
         file_annos = []
-        for f in files:
-            anno = save_file(colln, user, resource_id, f, purpose).to_json_map()
-            anno.pop('body', None)
-            file_annos.append(anno)
+        try:
+            for f in files:
+                anno = save_file(colln, user, resource_id, f, purpose).to_json_map()
+                anno.pop('body', None)
+                file_annos.append(anno)
+        finally:
+            if len(files):
+                resources_changed([resource_id])
         return file_annos
 
 
+@api.route('/resources/<string:resource_id>/uploads')
+class Uploads(flask_restplus.Resource):
+
+    post_parser = api.parser()
+    post_parser.add_argument('file_name', type=str, location='form', required=True)
+    post_parser.add_argument('total_size', type=int, location='form', required=True)
+    post_parser.add_argument('files_purpose', type=str, location='form')
+
+    @api.expect(post_parser, validate=True)
+    def post(self, resource_id):
+        """
+        creates a resumable upload session. then PUT chunks to /uploads/<upload_id>, and POST to
+        /uploads/<upload_id>/finalize once all are sent.
+        """
+        args = self.post_parser.parse_args()
+        colln = get_colln()
+        user = get_user(required=True)
+
+        try:
+            return create_upload_session(
+                colln, user, resource_id, args['file_name'], args['total_size'], purpose=args['files_purpose'])
+        except UploadError as e:
+            return error_response(message=str(e), code=e.code)
+
+
+@api.route('/uploads/<string:upload_id>')
+class Upload(flask_restplus.Resource):
+
+    put_parser = api.parser()
+    put_parser.add_argument('offset', type=int, location='args')
+
+    def get(self, upload_id):
+        colln = get_colln()
+        user = get_user(required=True)
+        try:
+            return upload_status(colln, user, upload_id)
+        except UploadError as e:
+            return error_response(message=str(e), code=e.code)
+
+    @api.expect(put_parser, validate=True)
+    def put(self, upload_id):
+        """
+        writes request body at offset (given either as offset argument, or by Content-Range header).
+        """
+        args = self.put_parser.parse_args()
+        colln = get_colln()
+        user = get_user(required=True)
+
+        offset = args['offset']
+        if offset is None and request.headers.get('Content-Range'):
+            content_range = parse_content_range_header(request.headers['Content-Range'])
+            offset = content_range.start if content_range is not None else None
+        if offset is None:
+            return error_response(message='offset or Content-Range is required', code=400)
+
+        try:
+            return write_upload_chunk(colln, user, upload_id, offset, request.stream)
+        except UploadError as e:
+            return error_response(message=str(e), code=e.code)
+
+    def delete(self, upload_id):
+        colln = get_colln()
+        user = get_user(required=True)
+        try:
+            cancel_upload(colln, user, upload_id)
+        except UploadError as e:
+            return error_response(message=str(e), code=e.code)
+        return {"success": True}
+
+
+@api.route('/uploads/<string:upload_id>/finalize')
+class UploadFinalization(flask_restplus.Resource):
+
+    def post(self, upload_id):
+        colln = get_colln()
+        user = get_user(required=True)
+
+        try:
+            anno = finalize_upload(colln, user, upload_id).to_json_map()
+        except UploadError as e:
+            return error_response(message=str(e), code=e.code)
+        anno.pop('body', None)
+        resources_changed([anno['target']])
+        return anno
+
+
 # noinspection PyMethodMayBeStatic
 @api.route('/files/<string:file_id>')
 class File(flask_restplus.Resource):
@@ -332,21 +653,14 @@ class File(flask_restplus.Resource):
     post_parser.add_argument('file', type=FileStorage, location='files')
 
     def get(self, file_id):
-        colln = get_colln()
-        file_anno_doc = db_helper.read_by_id(colln, file_id)
-        if file_anno_doc is None:
+        resolved_file = fs_helper().resolve_file(file_id)
+        if resolved_file is None:
             return error_response(message="file not found", code=404)
 
-        file_anno = JsonObject.make_from_dict(file_anno_doc)
-        target_resource_id = file_anno.target
-        abs_file_path = resource_file_path(target_resource_id, file_anno.body.path)
-
-        file_dir = os.path.dirname(abs_file_path)
-        file_name = os.path.basename(abs_file_path)
-        from flask import send_from_directory
-        return send_from_directory(
-            directory=file_dir, filename=file_name
-        )
+        abs_file_path, file_name = resolved_file
+        if not os.path.isfile(abs_file_path):
+            return error_response(message="file not found", code=404)
+        return file_response(abs_file_path, file_name=file_name)
 
     @api.expect(post_parser, validate=True)
     def post(self, file_id):
@@ -356,22 +670,21 @@ class File(flask_restplus.Resource):
         user = get_user(required=True)
         files = request.files.getlist("file")
 
-        file_anno_doc = db_helper.read_by_id(colln, file_id)
+        file_anno_doc = read_resource_doc(colln, file_id)
         if file_anno_doc is None:
             return error_response(message="file not found", code=404)
 
         file_anno = JsonObject.make_from_dict(file_anno_doc)
         target_resource_id = file_anno.target
-        target_resource = JsonObject.make_from_dict(db_helper.read_by_id(colln, target_resource_id))
-
-        has_update_permission = permission_manager.has_persmission(user, Permission.UPDATE, obj=target_resource)
+        # permissions are of service level; target resource need not be read for checking them.
+        has_update_permission = permission_manager.has_persmission(user, Permission.UPDATE)
 
         if not has_update_permission:
             return error_response(message="user has no permission for this operation", code=403)
         for f in files:
-            full_path = resource_file_path(target_resource_id, file_anno.body.path)
-            os.remove(full_path)
-            f.save(full_path)
+            replace_file_content(colln, file_anno, f)
+            fs_helper().invalidate([file_id])
+            resources_changed([target_resource_id])
             return {"success": True}
 
     def delete(self, file_id):
@@ -390,6 +703,8 @@ class Trees(flask_restplus.Resource):
 
     post_parser = api.parser()
     post_parser.add_argument('trees', type=str, location='form', required=True)
+    post_parser.add_argument('bulk', type=flask_restplus.inputs.boolean, location='form', default=False)
+    post_parser.add_argument('async', type=flask_restplus.inputs.boolean, location='form', default=False)
 
     @api.expect(post_parser, validate=True)
     def post(self):
@@ -400,22 +715,29 @@ class Trees(flask_restplus.Resource):
         trees = jsonify_argument(args['trees'], key='trees')
         check_argument_type(trees, (list,), key='trees')
 
-        result_trees = []
+        if args['async']:
+            job = submit_job(
+                'update_trees', update_trees_job, colln, user, trees, bulk=args['bulk'],
+                with_progress=True, submitted_by=get_user_id(user))
+            return job.to_json_map(), 202
+
+        if args['bulk']:
+            try:
+                result_trees, timings = bulk_update_tree(colln, user, trees)
+            except PermissionError as e:
+                return error_response(message=str(e), code=403)
+            except TreeCrawlError as e:
+                return error_response(message="error in tree crawling", code=404, **e.to_json_map())
+            return {
+                "trees": result_trees,
+                "timings": timings
+            }
+
         try:
-            for i, tree in enumerate(trees):
-                # noinspection PyTypeChecker
-                result_tree = update_tree(colln, user, tree, 'tree{}'.format(i), None)
-                result_trees.append(result_tree)
+            result_trees = update_trees(colln, user, trees)
         except TreeCrawlError as e:
             print(e)
-            return error_response(
-                message="error in tree crawling",
-                code=404,
-                error_position=e.tree_position,
-                succeded_trees=result_trees,
-                error=str(e.error),
-                node_json=e.node_json
-            )
+            return error_response(message="error in tree crawling", code=404, **e.to_json_map())
         return result_trees
 
 
@@ -428,9 +750,69 @@ class Tree(flask_restplus.Resource):
     get_parser.add_argument('annotation_filter', location='args', type=str)
     get_parser.add_argument('section_fields', location='args', type=str)
     get_parser.add_argument('annotation_fields', location='args', type=str)
+    get_parser.add_argument('associated_resources', location='args', type=str)
+    get_parser.add_argument('count_queries', location='args', type=flask_restplus.inputs.boolean, default=False)
+
+    @api.expect(get_parser, validate=True)
+    def get(self, root_node_id):
+        args = self.get_parser.parse_args()
+        colln = get_colln()
+
+        max_depth = args['max_depth']
+        specific_resource_filter = jsonify_argument(args['section_filter']) or {}
+        annotation_filter = jsonify_argument(args['annotation_filter']) or {}
+
+        specific_resource_fields = jsonify_argument(args['section_fields'])
+        annotation_fields = jsonify_argument(args['annotation_fields'])
+
+        associated_resources_request_doc = jsonify_argument(args['associated_resources'], 'associated_resources')
+        check_argument_type(associated_resources_request_doc, (dict,), key='associated_resources', allow_none=True)
+
+        query_counts = {} if args['count_queries'] else None
+
+        def build_body():
+            root_node = db_helper.read_by_id(colln, root_node_id)
+            if root_node is None:
+                return error_response(message="root node not found", code=404)
+
+            tree = read_tree(
+                colln, root_node, max_depth,
+                specific_resource_filter=specific_resource_filter,
+                annotation_filter=annotation_filter,
+                specific_resource_fields=specific_resource_fields,
+                annotation_fields=annotation_fields,
+                associated_resources_request_doc=associated_resources_request_doc,
+                query_counts=query_counts)
+
+            if query_counts is not None:
+                # root node read is also a query.
+                query_counts['total'] += 1
+                tree['query_counts'] = query_counts
+            return tree
+
+        if query_counts is not None:
+            # query counts are diagnostics of this very request; should not be served from client cache.
+            return build_body()
+        return conditional_response(versioned_etag(), build_body)
+
+
+@api.route('/trees/<root_node_id>/stream')
+class TreeStream(flask_restplus.Resource):
+
+    get_parser = api.parser()
+    get_parser.add_argument('max_depth', location='args', type=int, default=1, required=True)
+    get_parser.add_argument('section_filter', location='args', type=str)
+    get_parser.add_argument('annotation_filter', location='args', type=str)
+    get_parser.add_argument('section_fields', location='args', type=str)
+    get_parser.add_argument('annotation_fields', location='args', type=str)
+    get_parser.add_argument('resume_after', location='args', type=str)
 
     @api.expect(get_parser, validate=True)
     def get(self, root_node_id):
+        """
+        streams tree nodes as newline delimited json, in flat parent-pointer form.
+        if connection drops, pass _id of last received node as resume_after to continue from there.
+        """
         args = self.get_parser.parse_args()
         colln = get_colln()
 
@@ -442,13 +824,173 @@ class Tree(flask_restplus.Resource):
         annotation_fields = jsonify_argument(args['annotation_fields'])
 
         root_node = db_helper.read_by_id(colln, root_node_id)
-        tree = read_tree(
+        if root_node is None:
+            return error_response(message="root node not found", code=404)
+
+        resume_point = None
+        if args['resume_after'] is not None:
+            try:
+                resume_point = tree_resume_point(colln, root_node['_id'], args['resume_after'], max_depth)
+            except TreeResumeError as e:
+                return error_response(message=str(e), code=e.code)
+
+        nodes = iter_tree_nodes(
             colln, root_node, max_depth,
             specific_resource_filter=specific_resource_filter,
             annotation_filter=annotation_filter,
             specific_resource_fields=specific_resource_fields,
-            annotation_fields=annotation_fields)
-        return tree
+            annotation_fields=annotation_fields,
+            resume_after=args['resume_after'], resume_point=resume_point)
+
+        def generate():
+            for node in nodes:
+                yield json.dumps(node) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@api.route('/jobs')
+class Jobs(flask_restplus.Resource):
+
+    get_parser = api.parser()
+    get_parser.add_argument('status', location='args', type=str)
+    get_parser.add_argument('limit', location='args', type=int, default=50)
+
+    post_parser = api.parser()
+    post_parser.add_argument('operation', location='form', type=str, required=True, choices=list(job_operations.keys()))
+    post_parser.add_argument('params', location='form', type=str, required=True)
+
+    @api.expect(get_parser, validate=True)
+    def get(self):
+        """
+        lists recent jobs of this repo submitted by user, without their results.
+        """
+        args = self.get_parser.parse_args()
+        user = get_user(required=True)
+        return job_store().list(limit=args['limit'], status=args['status'], submitted_by=get_user_id(user))
+
+    @api.expect(post_parser, validate=True)
+    def post(self):
+        """
+        submits an operation as a job. params are keyword arguments of operation,
+        like {"trees": [...], "bulk": true} for update_trees, {"resource_ids": [...]} for delete_resources.
+        """
+        args = self.post_parser.parse_args()
+        colln = get_colln()
+        user = get_user(required=True)
+
+        params = jsonify_argument(args['params'], key='params')
+        check_argument_type(params, (dict,), key='params')
+
+        fn, allowed_params = job_operations[args['operation']]
+        unknown_params = [key for key in params if key not in allowed_params]
+        if len(unknown_params):
+            return error_response(message='unknown params {}'.format(unknown_params), code=400)
+        if args['operation'] == 'update_resources':
+            params['excluded_classes'] = Resources.white_listed_classes
+
+        job = submit_job(
+            args['operation'], fn, colln, user, with_progress=True, submitted_by=get_user_id(user), **params)
+        return job.to_json_map(), 202
+
+
+# noinspection PyMethodMayBeStatic
+@api.route('/jobs/<string:job_id>')
+class JobStatus(flask_restplus.Resource):
+
+    def get(self, job_id):
+        """
+        status, progress, and (once finished) result of a job.
+        jobs are visible only to users who submitted them; internal jobs (without a submitter) are shown
+        without their result.
+        """
+        user = get_user(required=True)
+        job = job_runner().get(job_id, store=job_store())
+        if job is None or job['submitted_by'] not in (None, get_user_id(user)):
+            return error_response(message="job not found", code=404)
+        if job['submitted_by'] is None:
+            job.pop('result', None)
+        return job
+
+
+# noinspection PyMethodMayBeStatic
+@api.route('/metrics')
+class Metrics(flask_restplus.Resource):
+
+    def get(self):
+        """
+        request latencies, response sizes, and db calls, in prometheus text format.
+        """
+        metrics = api_metrics()
+        if metrics is None:
+            return error_response(message="metrics are not enabled", code=404)
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# noinspection PyMethodMayBeStatic
+@api.route('/admin/indexes')
+class Indexes(flask_restplus.Resource):
+
+    def get(self):
+        """
+        explains canonical query shapes of ullekhanam, and flags those falling back to collection scan.
+        """
+        user = get_user(required=True)
+        if not permission_manager.has_persmission(user, Permission.UPDATE):
+            return error_response(message="user has no permission for this operation", code=403)
+        return index_report()
+
+    def post(self):
+        user = get_user(required=True)
+        if not permission_manager.has_persmission(user, Permission.UPDATE):
+            return error_response(message="user has no permission for this operation", code=403)
+        return {"created_indexes": ensure_indexes()}
+
+
+@api.route('/admin/query_profile')
+class QueryProfile(flask_restplus.Resource):
+
+    get_parser = api.parser()
+    get_parser.add_argument('limit', location='args', type=int, default=100)
+
+    @api.expect(get_parser, validate=True)
+    def get(self):
+        """
+        query shapes made on repo's collection, by total time taken, with latency percentiles,
+        slow query counts, and explain summaries of slow shapes.
+        """
+        args = self.get_parser.parse_args()
+        user = get_user(required=True)
+        if not permission_manager.has_persmission(user, Permission.UPDATE):
+            return error_response(message="user has no permission for this operation", code=403)
+        profiler = query_profiler()
+        if profiler is None:
+            return error_response(message="query profiler is not enabled", code=404)
+        return profiler.report(limit=args['limit'])
+
+    def delete(self):
+        user = get_user(required=True)
+        if not permission_manager.has_persmission(user, Permission.UPDATE):
+            return error_response(message="user has no permission for this operation", code=403)
+        profiler = query_profiler()
+        if profiler is None:
+            return error_response(message="query profiler is not enabled", code=404)
+        profiler.reset()
+        return {"success": True}
+
+
+# noinspection PyMethodMayBeStatic
+@api.route('/admin/caches')
+class Caches(flask_restplus.Resource):
+
+    def get(self):
+        user = get_user(required=True)
+        if not permission_manager.has_persmission(user, Permission.UPDATE):
+            return error_response(message="user has no permission for this operation", code=403)
+        return {
+            "resolved_paths": fs_helper().cache_stats(),
+            "manifests": prezi_interface().cache_stats()
+        }
 
 
 # noinspection PyMethodMayBeStatic
@@ -456,13 +998,7 @@ class Tree(flask_restplus.Resource):
 class Schemas(flask_restplus.Resource):
 
     def get(self):
-        from sanskrit_ld.schema import json_class_registry
-        schemas = {}
-        for k, v in json_class_registry.items():
-            if not hasattr(v, 'schema'):
-                continue
-            schemas[k] = v.schema
-        return schemas
+        return payload_response(schema_payloads().all_schemas)
 
 
 # noinspection PyMethodMayBeStatic
@@ -470,11 +1006,10 @@ class Schemas(flask_restplus.Resource):
 class Schema(flask_restplus.Resource):
 
     def get(self, json_class):
-        from sanskrit_ld.schema import json_class_registry
-        class_obj = json_class_registry.get(json_class, None)
-        if class_obj is None:
+        payload = schema_payloads().schemas.get(json_class, None)
+        if payload is None:
             return error_response(message='{} is not defined'.format(json_class))
-        return class_obj.schema
+        return payload_response(payload)
 
 
 # noinspection PyMethodMayBeStatic
@@ -482,14 +1017,7 @@ class Schema(flask_restplus.Resource):
 class Contexts(flask_restplus.Resource):
 
     def get(self):
-        from sanskrit_ld.schema import json_class_registry
-
-        contexts = {}
-        for k, v in json_class_registry.items():
-            if not hasattr(v, 'context'):
-                continue
-            contexts[k] = v.context
-        return contexts
+        return payload_response(schema_payloads().all_contexts)
 
 
 # noinspection PyMethodMayBeStatic
@@ -497,8 +1025,7 @@ class Contexts(flask_restplus.Resource):
 class Context(flask_restplus.Resource):
 
     def get(self, json_class):
-        from sanskrit_ld.schema import json_class_registry
-        class_obj = json_class_registry.get(json_class, None)
-        if class_obj is None:
+        payload = schema_payloads().contexts.get(json_class, None)
+        if payload is None:
             return error_response(message='{} is not defined'.format(json_class))
-        return class_obj.context
+        return payload_response(payload)
@@ -0,0 +1,244 @@
+"""
+offline loader, for initial loads of large corpora of scanned books, directly into repo's db and file store,
+bypassing http api.
+
+books are directories with a book.json (same format as examples/import_books.py)::
+
+    {"title": "a_title", "author": "author_1,author_2", "pages": [{"fname": "page_1.jpg"}, ...]}
+
+book.json files are parsed, converted into BookPortion, Page and FileAnnotation objects,
+and validated in a pool of processes. validated docs are then written with unordered insert_many batches,
+after their page images are hard linked (or copied, when on a different filesystem) into resource directories
+by a pool of threads.
+
+in process, with a repo of running service::
+
+    load_books(VedavaapiUllekhanam.instance.get_repo(repo_name), [books_root], creator=user_id)
+
+or from command line, against db and data directory of a repo::
+
+    python -m vedavaapi.ullekhanam.bulk_loader --mongo_uri mongodb://localhost --db ullekhanam_db \\
+        --data_dir /path/to/repo/data/ullekhanam --creator some_user_id books_root ...
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
+from bson import ObjectId
+
+
+def find_book_dirs(roots):
+    for root_dir in roots:
+        for root, directories, filenames in os.walk(root_dir):
+            directories.sort()
+            if 'book.json' in filenames:
+                yield os.path.abspath(root)
+
+
+def _creation_details(obj, creator):
+    obj.creator = creator
+    obj.contributor = [creator]
+    obj.update_time()
+
+
+def prepare_book(args):
+    """
+    runs in worker processes. parses and validates a book directory.
+
+    :return: (book_dir, docs, links, error). docs are db ready json maps with ObjectId _ids,
+        links are (source_file_path, resource_id, file_name) triples.
+    """
+    book_dir, creator, purpose = args
+    # imported in workers, so that schema classes are loaded once per process, and not pickled around.
+    from sanskrit_ld.schema import JsonObject
+    from sanskrit_ld.schema.base import FileDescriptor
+    from sanskrit_ld.schema.base.annotations import FileAnnotation
+    from . import validation
+
+    try:
+        with open(os.path.join(book_dir, 'book.json')) as fh:
+            book = json.load(fh)
+
+        book_id = str(ObjectId())
+        book_json = {
+            "jsonClass": "BookPortion",
+            "_id": book_id,
+            "title": {"jsonClass": "Text", "chars": book["title"]},
+            "metadata": [
+                {"label": "author", "value": author.strip()} for author in book.get("author", "").split(',')
+                if author.strip()
+            ]
+        }
+        book_json.update(book.get("content", {}))
+        objects = [JsonObject.make_from_dict(book_json)]
+        links = []
+
+        for n, page in enumerate(book["pages"]):
+            page_id = str(ObjectId())
+            page_json = {
+                "jsonClass": "Page",
+                "_id": page_id,
+                "source": book_id,
+                "label": "page {}".format(n + 1)
+            }
+            page_json.update(page.get("content", {}))
+            objects.append(JsonObject.make_from_dict(page_json))
+
+            file_name = os.path.basename(page["fname"])
+            source_file_path = os.path.join(book_dir, page["fname"])
+            if not os.path.isfile(source_file_path):
+                raise IOError('page file {} does not exist'.format(source_file_path))
+            file_anno = FileAnnotation.from_details(FileDescriptor.from_details(file_name), page_id, purpose=purpose)
+            file_anno._id = str(ObjectId())
+            objects.append(file_anno)
+            links.append((source_file_path, page_id, file_name))
+
+        for obj in objects:
+            _creation_details(obj, creator)
+        errors = validation.validate_many(objects)
+        if len(errors):
+            n, error = errors[0]
+            raise ValueError('{} th object is invalid: {}'.format(n, error))
+
+        docs = []
+        for obj in objects:
+            doc = obj.to_json_map()
+            doc['_id'] = ObjectId(doc['_id'])
+            docs.append(doc)
+        return book_dir, docs, links, None
+    except Exception as e:
+        return book_dir, None, None, '{}: {}'.format(type(e).__name__, e)
+
+
+def link_file(source_file_path, target_file_path):
+    """
+    hard links source file to target, falling back to copy, if they are on different filesystems.
+    :return: 'linked' or 'copied'
+    """
+    os.makedirs(os.path.dirname(target_file_path), exist_ok=True)
+    try:
+        os.link(source_file_path, target_file_path)
+        return 'linked'
+    except FileExistsError:
+        return 'linked'
+    except OSError:
+        shutil.copyfile(source_file_path, target_file_path)
+        return 'copied'
+
+
+class BulkLoader(object):
+
+    def __init__(
+            self, mongo_colln, resource_dir_path, creator, purpose='source',
+            processes=None, io_threads=32, batch_size=10000):
+        """
+        :param mongo_colln: raw pymongo collection of repo.
+        :param resource_dir_path: function giving directory of a resource, by it's id.
+        """
+        self.mongo_colln = mongo_colln
+        self.resource_dir_path = resource_dir_path
+        self.creator = creator
+        self.purpose = purpose
+        self.processes = processes
+        self.io_threads = io_threads
+        self.batch_size = batch_size
+        self.stats = {
+            "books": 0, "pages": 0, "docs": 0, "linked": 0, "copied": 0, "failed_books": [],
+            "seconds": {"insert": 0, "files": 0, "total": 0}
+        }
+        self.book_ids = []
+
+    def load(self, roots):
+        start = time.time()
+        batch_docs = []
+        batch_links = []
+        jobs = ((book_dir, self.creator, self.purpose) for book_dir in find_book_dirs(roots))
+
+        with Pool(processes=self.processes) as pool, ThreadPoolExecutor(max_workers=self.io_threads) as io_pool:
+            for book_dir, docs, links, error in pool.imap_unordered(prepare_book, jobs, chunksize=4):
+                if error is not None:
+                    logging.error('skipping {}; {}'.format(book_dir, error))
+                    self.stats['failed_books'].append({"book_dir": book_dir, "error": error})
+                    continue
+                batch_docs.extend(docs)
+                batch_links.extend(links)
+                self.book_ids.append(str(docs[0]['_id']))
+                self.stats['books'] += 1
+                self.stats['pages'] += len(links)
+                if len(batch_docs) >= self.batch_size:
+                    self._flush(io_pool, batch_docs, batch_links)
+                    batch_docs, batch_links = [], []
+            if len(batch_docs):
+                self._flush(io_pool, batch_docs, batch_links)
+
+        self.stats['seconds']['total'] = time.time() - start
+        self.stats['pages_per_hour'] = self.stats['pages'] * 3600 / max(self.stats['seconds']['total'], 1e-6)
+        return self.stats
+
+    def _flush(self, io_pool, docs, links):
+        # files first, so that no doc refers to a file which is not there, if load is interrupted.
+        start = time.time()
+        targets = [os.path.join(self.resource_dir_path(resource_id), file_name) for _, resource_id, file_name in links]
+        for outcome in io_pool.map(link_file, [link[0] for link in links], targets):
+            self.stats[outcome] += 1
+        self.stats['seconds']['files'] += time.time() - start
+
+        start = time.time()
+        self.mongo_colln.insert_many(docs, ordered=False)
+        self.stats['docs'] += len(docs)
+        self.stats['seconds']['insert'] += time.time() - start
+        logging.info('loaded {} books, {} pages'.format(self.stats['books'], self.stats['pages']))
+
+
+def load_books(repo, roots, creator, **kwargs):
+    """
+    loads books under roots into repo (an UllekhanamRepo), and notifies it's caches of them.
+    """
+    loader = BulkLoader(repo.ullekhanam_colln.mongo_collection, repo.resource_dir_path, creator, **kwargs)
+    stats = loader.load(roots)
+    repo.bump_write_version()
+    repo.prezi_interface().books_changed(loader.book_ids)
+    return stats
+
+
+def main():
+    from pymongo import MongoClient, UpdateOne
+
+    parser = argparse.ArgumentParser(description='loads books directly into ullekhanam db and file store.')
+    parser.add_argument('roots', nargs='+', help='directories to search for book directories')
+    parser.add_argument('--mongo_uri', default='mongodb://localhost:27017')
+    parser.add_argument('--db', required=True, help='ullekhanam db of repo')
+    parser.add_argument('--collection', default='ullekhanam')
+    parser.add_argument('--meta_collection', default='ullekhanam_meta')
+    parser.add_argument('--data_dir', required=True, help='data directory of repo, in which resource dirs are')
+    parser.add_argument('--creator', required=True, help='user id, to be recorded as creator')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--io_threads', type=int, default=32)
+    parser.add_argument('--batch_size', type=int, default=10000)
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo_uri)[args.db]
+    loader = BulkLoader(
+        db[args.collection], lambda resource_id: os.path.join(args.data_dir, resource_id), args.creator,
+        processes=args.processes, io_threads=args.io_threads, batch_size=args.batch_size)
+    stats = loader.load(args.roots)
+    # so that etags, materialized books and ordered books indexes of running servers catch up.
+    meta_colln = db[args.meta_collection]
+    meta_colln.update_one({"_id": "write_version"}, {"$inc": {"version": 1}}, upsert=True)
+    meta_colln.update_one({"_id": "books_index_version"}, {"$inc": {"version": 1}}, upsert=True)
+    if len(loader.book_ids):
+        meta_colln.bulk_write([
+            UpdateOne({"_id": 'book_version:' + book_id}, {"$inc": {"version": 1}}, upsert=True)
+            for book_id in loader.book_ids
+        ], ordered=False)
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(asctime)s %(message)s")
+    main()
@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUTTLCache(object):
+    """
+    thread safe cache, bounded both in size (least recently used entries are evicted first),
+    and in time (entries older than ttl seconds are not served). keeps hit/miss counters.
+    """
+
+    def __init__(self, max_size=10000, ttl=300, on_evict=None):
+        """
+        :param on_evict: function(key, value), called when an entry is dropped for size, or for expiry.
+            not called for explicit invalidations.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.entries = OrderedDict()  # key: (value, stored_at)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _notify_evicted(self, evicted):
+        if self.on_evict is None:
+            return
+        for key, value in evicted:
+            self.on_evict(key, value)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, stored_at = entry
+            expired = self.ttl is not None and time.time() - stored_at > self.ttl
+            if expired:
+                del self.entries[key]
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        if expired:
+            self._notify_evicted([(key, value)])
+            return default
+        return value
+
+    def peek(self, key, default=None):
+        """
+        like get, but doesn't count as a hit/miss, or as a use for lru order.
+        """
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None or (self.ttl is not None and time.time() - entry[1] > self.ttl):
+                return default
+            return entry[0]
+
+    def __contains__(self, key):
+        return self.peek(key) is not None
+
+    def put(self, key, value):
+        evicted = []
+        with self.lock:
+            self.entries[key] = (value, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                evicted_key, (evicted_value, stored_at) = self.entries.popitem(last=False)
+                evicted.append((evicted_key, evicted_value))
+                self.evictions += 1
+        self._notify_evicted(evicted)
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
@@ -0,0 +1,170 @@
+"""
+Optional content addressed store for resource files. Each distinct content is stored once as a blob, named by it's
+sha256 digest, and FileAnnotations refer to it through their body.path, as ``cas:sha256:<hexdigest>/<file_name>``.
+blobs are stored without extension, as same content can be uploaded under different names;
+hard linked aliases with extension (``<hexdigest>.jpg``) are made on demand, for consumers which detect format by it.
+"""
+
+import glob
+import hashlib
+import os
+import time
+import uuid
+
+path_reference_prefix = 'cas:sha256:'
+
+
+def make_path_reference(digest, file_name):
+    return '{}{}/{}'.format(path_reference_prefix, digest, file_name)
+
+
+def parse_path_reference(path):
+    """
+    :return: (digest, file_name) if path refers to a blob, else None
+    """
+    if not isinstance(path, str) or not path.startswith(path_reference_prefix):
+        return None
+    digest, sep, file_name = path[len(path_reference_prefix):].partition('/')
+    return digest, file_name
+
+
+def path_reference_regex(digest=None):
+    return '^{}{}'.format(path_reference_prefix, '{}/'.format(digest) if digest else '')
+
+
+class ContentAddressedStore(object):
+    """
+    blobs are reference counted in refs_colln, with one {_id: digest, count, updated} doc per blob,
+    changed only with atomic $inc.
+
+    a reference is taken (put_stream, put_file) before blob file is committed, and is to be released (release)
+    when referring FileAnnotation is gone, or could not be created.
+    blobs are removed by sweep, only after their count stayed 0 for grace_seconds; removal is re-checked against
+    a concurrent put of same content, which would have taken a reference meanwhile.
+    """
+
+    def __init__(self, root_dir_path, refs_colln, block_size=1024 * 1024, grace_seconds=60):
+        """
+        :param refs_colln: raw pymongo collection for reference counts.
+        """
+        self.root_dir_path = root_dir_path
+        self.refs_colln = refs_colln
+        self.block_size = block_size
+        self.grace_seconds = grace_seconds
+
+    def blob_path(self, digest, file_name=None):
+        """
+        :param file_name: if given, and has an extension, path of an alias of blob with that extension is given.
+        """
+        path = os.path.join(self.root_dir_path, digest[:2], digest[2:4], digest)
+        extension = os.path.splitext(file_name)[1].lower() if file_name else ''
+        if not extension:
+            return path
+        alias_path = path + extension
+        if not os.path.exists(alias_path):
+            try:
+                os.link(path, alias_path)
+            except FileExistsError:
+                pass
+            except OSError:
+                # blob is not there (any more), or filesystem has no hard links.
+                return path
+        return alias_path
+
+    def _tmp_path(self):
+        tmp_dir_path = os.path.join(self.root_dir_path, 'tmp')
+        os.makedirs(tmp_dir_path, exist_ok=True)
+        return os.path.join(tmp_dir_path, uuid.uuid4().hex)
+
+    def _commit(self, tmp_path, digest):
+        try:
+            # reference is taken first, so that a concurrent sweep cannot remove blob once we found it there.
+            self.refs_colln.update_one(
+                {"_id": digest}, {"$inc": {"count": 1}, "$set": {"updated": time.time()}}, upsert=True)
+            blob_path = self.blob_path(digest)
+            if os.path.exists(blob_path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(tmp_path, blob_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest
+
+    def put_stream(self, stream):
+        """
+        writes stream to a temporary file, hashing it as it is written, and moves it to it's blob path,
+        unless that content is already there. a reference to blob is taken; caller should release it,
+        if it could not record that reference.
+
+        :return: hex digest of content
+        """
+        sha256 = hashlib.sha256()
+        tmp_path = self._tmp_path()
+        try:
+            with open(tmp_path, 'wb') as tmp_file:
+                while True:
+                    block = stream.read(self.block_size)
+                    if not block:
+                        break
+                    sha256.update(block)
+                    tmp_file.write(block)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return self._commit(tmp_path, sha256.hexdigest())
+
+    def put_file(self, file_path):
+        """
+        moves an already written file (like a finished upload) into store. takes a reference, as put_stream.
+        """
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            while True:
+                block = f.read(self.block_size)
+                if not block:
+                    break
+                sha256.update(block)
+        tmp_path = self._tmp_path()
+        os.replace(file_path, tmp_path)
+        return self._commit(tmp_path, sha256.hexdigest())
+
+    def release(self, digest):
+        """
+        drops a reference to blob. blob itself is removed by a later sweep, if no reference is taken meanwhile.
+        """
+        self.refs_colln.update_one(
+            {"_id": digest}, {"$inc": {"count": -1}, "$set": {"updated": time.time()}})
+
+    def sweep(self):
+        """
+        removes blobs, whose reference count is 0 since at least grace_seconds.
+
+        :return: number of blobs removed
+        """
+        removed_count = 0
+        expired_before = time.time() - self.grace_seconds
+        for ref_doc in list(self.refs_colln.find({"count": {"$lte": 0}, "updated": {"$lt": expired_before}})):
+            digest = ref_doc['_id']
+            deleted = self.refs_colln.delete_one(
+                {"_id": digest, "count": {"$lte": 0}, "updated": {"$lt": expired_before}})
+            if not deleted.deleted_count:
+                continue
+            blob_path = self.blob_path(digest)
+            tombstone_path = self._tmp_path()
+            try:
+                os.replace(blob_path, tombstone_path)
+            except FileNotFoundError:
+                continue
+            if self.refs_colln.find_one({"_id": digest}) is not None and not os.path.exists(blob_path):
+                # content was put again, after count doc was deleted, and found blob still there; restore it.
+                os.replace(tombstone_path, blob_path)
+                continue
+            os.remove(tombstone_path)
+            for alias_path in glob.glob(glob.escape(blob_path) + '.*'):
+                os.remove(alias_path)
+            removed_count += 1
+        return removed_count
@@ -0,0 +1,103 @@
+"""
+Indexes needed by hot access paths on ullekhanam collection, and explain based verification of them.
+"""
+
+from pymongo import ASCENDING
+
+# name, keys
+index_specs = [
+    # annotations and file annotations of a resource
+    ('target_1', [('target', ASCENDING)]),
+    # sections of a resource
+    ('source_1', [('source', ASCENDING)]),
+    # listing by class, sorted by title; default books collection
+    ('jsonClass_1_title.chars_1_id_1', [('jsonClass', ASCENDING), ('title.chars', ASCENDING), ('_id', ASCENDING)]),
+    # pages of a book; default sequence
+    ('jsonClass_1_source_1', [('jsonClass', ASCENDING), ('source', ASCENDING)]),
+    # files of a resource
+    ('jsonClass_1_target_1', [('jsonClass', ASCENDING), ('target', ASCENDING)]),
+    # reference counting of content addressed blobs, by path prefix
+    ('body.path_1', [('body.path', ASCENDING)]),
+]
+
+# name, filter, sort
+canonical_query_shapes = [
+    ('annotations_of_resource', {"target": "_"}, None),
+    ('sections_of_resource', {"source": "_"}, None),
+    ('files_of_resource', {"jsonClass": "FileAnnotation", "target": "_"}, None),
+    ('resources_by_class', {"jsonClass": "_"}, None),
+    ('default_books_collection', {"jsonClass": "BookPortion"}, [("title.chars", ASCENDING)]),
+    ('default_sequence_pages', {"jsonClass": "Page", "source": "_"}, None),
+]
+
+
+def _normalized_keys(keys):
+    # directions may come back from server as floats (1.0).
+    return tuple(
+        (field, int(direction) if isinstance(direction, (int, float)) else direction) for field, direction in keys)
+
+
+def ensure_indexes(mongo_colln):
+    """
+    creates declared indexes, which are not already there.
+    existing indexes are matched by their key specs, and not by names, so that same index created
+    under other name (say, manually) is not created again.
+
+    :type mongo_colln: pymongo.collection.Collection
+    :return: names of indexes created.
+    """
+    existing_keys = set(
+        _normalized_keys(index_info['key']) for index_info in mongo_colln.index_information().values())
+    created = []
+    for name, keys in index_specs:
+        if _normalized_keys(keys) in existing_keys:
+            continue
+        mongo_colln.create_index(keys, name=name, background=True)
+        created.append(name)
+    return created
+
+
+def _plan_stages(plan):
+    stages = [plan.get('stage')]
+    if 'inputStage' in plan:
+        stages.extend(_plan_stages(plan['inputStage']))
+    for input_stage in plan.get('inputStages', []):
+        stages.extend(_plan_stages(input_stage))
+    return stages
+
+
+def explain_summary(mongo_colln, filter_doc, sort=None):
+    cursor = mongo_colln.find(filter_doc)
+    if sort:
+        cursor = cursor.sort(sort)
+    explanation = cursor.explain()
+    winning_plan = explanation.get('queryPlanner', {}).get('winningPlan', {})
+    stages = [stage for stage in _plan_stages(winning_plan) if stage is not None]
+    execution_stats = explanation.get('executionStats', {})
+    return {
+        "stages": stages,
+        "collection_scan": 'COLLSCAN' in stages,
+        "in_memory_sort": 'SORT' in stages,
+        "keys_examined": execution_stats.get('totalKeysExamined'),
+        "docs_examined": execution_stats.get('totalDocsExamined')
+    }
+
+
+def index_report(mongo_colln):
+    """
+    runs explain on each canonical query shape, and flags those which fall back to collection scan.
+    """
+    report = []
+    for name, filter_doc, sort in canonical_query_shapes:
+        summary = explain_summary(mongo_colln, filter_doc, sort=sort)
+        summary.update({
+            "query_shape": name,
+            "filter": filter_doc,
+            "sort": sort
+        })
+        report.append(summary)
+    return {
+        "indexes": sorted(mongo_colln.index_information().keys()),
+        "query_shapes": report,
+        "collection_scans": [r['query_shape'] for r in report if r['collection_scan']]
+    }
@@ -1,35 +1,378 @@
+import base64
+import bisect
+import copy
+import json
+import os
+import threading
+import time
 from collections import OrderedDict
+from urllib.parse import quote
 
+from bson import ObjectId
+from flask import has_request_context, request
 from sanskrit_ld.helpers import db_helper
-from sanskrit_ld.schema import JsonObject
+from werkzeug.exceptions import BadRequest
 
 from vedavaapi.iiif_image.loris.resolver import ServiceFSHelper
 from vedavaapi.iiif_presentation.prezed.sevices_helper import ServicePreziInterface
 
+from .caching import LRUTTLCache
+from .content_store import parse_path_reference
+
 
 def myservice():
     from . import VedavaapiUllekhanam
     return VedavaapiUllekhanam.instance
 
 
+class OrderedBooksIndex(object):
+    """
+    (title, _id) keys of all books, kept in order, so that pages of books collection can be served by keyset,
+    without reading and sorting all books each time. built with one query on first use,
+    and maintained incrementally as books change. rebuilt after ttl, or when books index version (kept in db,
+    and bumped by writes of any process, and by bulk loads) changes; it is checked at most every revalidate_seconds.
+    queries are run outside of lock; while an expired index is being rebuilt, others are served from old one.
+    """
+
+    def __init__(self, colln, ttl=3600, version_source=None, revalidate_seconds=5):
+        """
+        :param version_source: function giving current books index version.
+        """
+        self.colln = colln
+        self.ttl = ttl
+        self.version_source = version_source
+        self.revalidate_seconds = revalidate_seconds
+        self.keys = None
+        self.keys_by_id = {}
+        self.built_at = None
+        self.version = None
+        self.validated_at = None
+        self.lock = threading.RLock()
+        # only one build at a time
+        self.build_lock = threading.Lock()
+        # ids of books refreshed while a build is in progress, which are to be refreshed again after it.
+        self.refreshed_during_build = None
+
+    @classmethod
+    def key(cls, book):
+        title = book.get('title', {})
+        title_chars = title.get('chars', '') if isinstance(title, dict) else ''
+        return title_chars if isinstance(title_chars, str) else '', str(book['_id'])
+
+    def is_built(self):
+        return self.keys is not None
+
+    def build(self):
+        with self.lock:
+            self.refreshed_during_build = set()
+        try:
+            version = self.version_source() if self.version_source is not None else None
+            ops = OrderedDict([
+                ('sort', [[["title.chars", 1], ["_id", 1]]])
+            ])
+            books = db_helper.read_and_do(
+                self.colln, {"jsonClass": "BookPortion"}, ops=ops, fields=['_id', 'title.chars'],
+                return_generator=True)
+            keys = sorted([self.key(book) for book in books])
+        finally:
+            with self.lock:
+                refreshed_ids = self.refreshed_during_build
+                self.refreshed_during_build = None
+        with self.lock:
+            self.keys = keys
+            self.keys_by_id = dict((book_id, (title, book_id)) for title, book_id in keys)
+            self.built_at = self.validated_at = time.time()
+            self.version = version
+        if len(refreshed_ids):
+            # they may have been read by build before they changed.
+            self.refresh(list(refreshed_ids))
+
+    def _needs_build(self):
+        with self.lock:
+            if self.keys is None or time.time() - self.built_at > self.ttl:
+                return True
+            if self.version_source is None or time.time() - self.validated_at < self.revalidate_seconds:
+                return False
+        version = self.version_source()
+        with self.lock:
+            if version != self.version:
+                return True
+            self.validated_at = time.time()
+            return False
+
+    def _ensure_built(self):
+        if not self._needs_build():
+            return
+        # first build is waited for; rebuilds of an expired index are left to whoever started them.
+        if not self.build_lock.acquire(blocking=not self.is_built()):
+            return
+        try:
+            if self._needs_build():
+                self.build()
+        finally:
+            self.build_lock.release()
+
+    def __len__(self):
+        self._ensure_built()
+        with self.lock:
+            return len(self.keys)
+
+    def page(self, after_key, size):
+        self._ensure_built()
+        with self.lock:
+            start = bisect.bisect_right(self.keys, tuple(after_key)) if after_key is not None else 0
+            return self.keys[start:start + size]
+
+    def refresh(self, book_ids, version=None):
+        """
+        re-reads given books, and updates their keys. books which are not there any more are removed.
+        :param version: books index version after bumping for this change. adopted only if it is next to ours,
+        so that changes from other processes are not skipped.
+        """
+        oids = [ObjectId(_id) if ObjectId.is_valid(_id) else _id for _id in book_ids]
+        books = db_helper.read_and_do(
+            self.colln, {"_id": {"$in": oids}, "jsonClass": "BookPortion"}, OrderedDict(),
+            fields=['_id', 'title.chars'], return_generator=True)
+        new_keys = dict((str(book['_id']), self.key(book)) for book in books)
+        with self.lock:
+            if self.refreshed_during_build is not None:
+                self.refreshed_during_build.update(book_ids)
+            if self.keys is None:
+                return
+            if version is not None and self.version is not None and version == self.version + 1:
+                self.version = version
+            for book_id in book_ids:
+                old_key = self.keys_by_id.pop(book_id, None)
+                if old_key is not None:
+                    index = bisect.bisect_left(self.keys, old_key)
+                    if index < len(self.keys) and self.keys[index] == old_key:
+                        del self.keys[index]
+                if book_id in new_keys:
+                    bisect.insort(self.keys, new_keys[book_id])
+                    self.keys_by_id[book_id] = new_keys[book_id]
+
+    @classmethod
+    def encode_page_token(cls, key):
+        return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+    @classmethod
+    def decode_page_token(cls, page_token):
+        """
+        :return: (title, book_id) key, or None, if token is malformed.
+        """
+        try:
+            title, book_id = json.loads(base64.urlsafe_b64decode(page_token.encode('ascii')).decode('utf-8'))
+        except (ValueError, TypeError, UnicodeError):
+            return None
+        if not isinstance(title, str) or not isinstance(book_id, str):
+            return None
+        return title, book_id
+
+
 class UllekhanamPreziInterface(ServicePreziInterface):
+    """
+    details of objects (books), their default sequence, and canvases are materialized per book on first request,
+    and served from store afterwards. writes through REST endpoints invalidate materializations of affected books,
+    and rebuild them in background.
+    materializations are per process; each is stamped with book's version (kept in db), and is revalidated against it
+    at most every revalidate_seconds, so that writes through other processes are caught up with.
+    """
 
     service_name = 'ullekhanam'
 
+    # how far to walk up target/source links, to find book of a changed resource. (file -> region -> page -> book)
+    max_ancestry_depth = 5
+
     def __init__(self, repo_name):
         super(UllekhanamPreziInterface, self).__init__(repo_name)
         self.colln = myservice().colln(self.repo_name)
 
+        cache_config = myservice().config.get('manifests_cache', {})
+        max_books = cache_config.get('max_books', 1000)
+        ttl = cache_config.get('ttl', 3600)
+        self.revalidate_seconds = cache_config.get('revalidate_seconds', 5)
+        self.materialized_books = LRUTTLCache(max_size=max_books, ttl=ttl, on_evict=self._forget_canvases)
+        # canvas_id -> book_id, for canvases of materialized books; canvases live and die with their book.
+        self.canvas_books = {}
+        self.canvas_books_lock = threading.Lock()
+        # resource_id -> (jsonClass, source/target links), to walk up to books without a query per level.
+        self.resource_links = LRUTTLCache(
+            max_size=cache_config.get('max_links', 100000), ttl=cache_config.get('links_ttl', 300))
+
+        collection_config = myservice().config.get('books_collection', {})
+        self.collection_page_size = collection_config.get('page_size', 100)
+        # like "{url_root}iiif_presentation/v1/collections/{collection_id}"; derived from request url, if not given.
+        self.collection_page_uri_template = collection_config.get('page_uri_template', None)
+        self.books_index = OrderedBooksIndex(
+            self.colln, ttl=collection_config.get('ttl', 3600),
+            version_source=lambda: myservice().books_index_version(self.repo_name),
+            revalidate_seconds=collection_config.get('revalidate_seconds', 5))
+
     def collection_details(self, collection_id):
         # meta, objects
         # TODO should implement collections
-        if collection_id != 'books':
+        # pages of default collection have ids like books@<page_token>
+        collection_name, sep, page_token = collection_id.partition('@')
+        if collection_name != 'books':
             return None
-        return self._default_collection_details()
+        return self._default_collection_details(collection_id, page_token=page_token or None)
 
     def object_details(self, object_id):
         # meta, default_sequence_id, sequence_ids
+        materialized_book = self.materialized_book(object_id)
+        if materialized_book is None:
+            return None
+        return copy.deepcopy(materialized_book['object'])
+
+    def sequence_details(self, object_id, sequence_id):
+        # meta, canvases
+        # TODO should implement sequences
+        if sequence_id != 'default':
+            return None
+        materialized_book = self.materialized_book(object_id)
+        if materialized_book is None:
+            return None
+        return copy.deepcopy(materialized_book['sequences'][sequence_id])
+
+    def canvas_details(self, sequence_id, canvas_id):
+        # meta, image_id or (image_ids and dimensions)
+        with self.canvas_books_lock:
+            book_id = self.canvas_books.get(canvas_id)
+        details = None
+        if book_id is not None:
+            materialized_book = self.materialized_book(book_id)
+            if materialized_book is not None:
+                details = materialized_book['canvases'].get(canvas_id)
+        if details is None:
+            details = self._canvas_details(sequence_id, canvas_id)
+            if details is None:
+                return None
+        return copy.deepcopy(details)
+
+    def materialized_book(self, object_id):
+        materialized_book = self.materialized_books.get(object_id)
+        if materialized_book is not None and not self._is_current(object_id, materialized_book):
+            self.invalidate_books([object_id], rebuild=False)
+            materialized_book = None
+        if materialized_book is None:
+            materialized_book = self.materialize_book(object_id)
+        return materialized_book
+
+    def _is_current(self, book_id, materialized_book):
+        if time.time() - materialized_book['validated_at'] < self.revalidate_seconds:
+            return True
+        version = myservice().book_versions(self.repo_name, [book_id])[book_id]
+        if version != materialized_book['version']:
+            return False
+        materialized_book['validated_at'] = time.time()
+        return True
+
+    def materialize_book(self, object_id):
+        # version is read before details, so that a write racing with build leaves it stale, and not current.
+        version = myservice().book_versions(self.repo_name, [object_id])[object_id]
+        object_details = self._object_details(object_id)
+        if object_details is None:
+            return None
+        default_sequence_details = self._default_sequence_details(object_id)
+        canvases = self._canvases_details('default', default_sequence_details['canvas_ids'])
+
+        materialized_book = {
+            "object": object_details,
+            "sequences": {
+                "default": default_sequence_details
+            },
+            "canvases": canvases,
+            "version": version,
+            "validated_at": time.time()
+        }
+        self.materialized_books.put(object_id, materialized_book)
+        with self.canvas_books_lock:
+            for canvas_id, details in canvases.items():
+                if details is not None:
+                    self.canvas_books[canvas_id] = object_id
+        return materialized_book
+
+    def _forget_canvases(self, book_id, materialized_book):
+        with self.canvas_books_lock:
+            for canvas_id in materialized_book['canvases'].keys():
+                if self.canvas_books.get(canvas_id) == book_id:
+                    del self.canvas_books[canvas_id]
+
+    def invalidate_books(self, book_ids, rebuild=True):
+        for book_id in book_ids:
+            materialized_book = self.materialized_books.peek(book_id)
+            if materialized_book is None:
+                continue
+            self.materialized_books.invalidate([book_id])
+            self._forget_canvases(book_id, materialized_book)
+            if rebuild:
+                myservice().job_runner.submit('materialize_book', self.materialize_book, book_id)
+
+    def book_ids_of(self, resource_ids):
+        """
+        finds books, to which given resources (books themselves, pages, regions, files, ...) belong,
+        walking up target/source links.
+        given resources are read afresh, as their links may just have been written;
+        links of their ancestors are served from resource_links where possible, so a typical write costs one query.
+        """
+        book_ids = set()
+        level_ids = list(set(resource_ids))
+        seen_ids = set(level_ids)
+        for depth in range(self.max_ancestry_depth):
+            if not len(level_ids):
+                break
+            level_links = {}
+            if depth > 0:
+                for _id in level_ids:
+                    links = self.resource_links.get(_id)
+                    if links is not None:
+                        level_links[_id] = links
+            unknown_ids = [_id for _id in level_ids if _id not in level_links]
+            if len(unknown_ids):
+                docs = db_helper.read_and_do(
+                    self.colln,
+                    {"_id": {"$in": [ObjectId(_id) if ObjectId.is_valid(_id) else _id for _id in unknown_ids]}},
+                    OrderedDict(), fields=['_id', 'jsonClass', 'source', 'target'], return_generator=True)
+                for doc in docs:
+                    links = (doc.get('jsonClass'), [
+                        doc.get(link_field) for link_field in ('source', 'target')
+                        if isinstance(doc.get(link_field), str)])
+                    level_links[str(doc['_id'])] = links
+                    self.resource_links.put(str(doc['_id']), links)
+
+            next_level_ids = []
+            for _id, (json_class, links) in level_links.items():
+                if json_class == 'BookPortion':
+                    book_ids.add(_id)
+                for link in links:
+                    if link not in seen_ids:
+                        seen_ids.add(link)
+                        next_level_ids.append(link)
+            level_ids = next_level_ids
+        return list(book_ids)
+
+    def books_changed(self, book_ids):
+        # other processes see bumped versions, and drop their materializations of these books on next use.
+        myservice().bump_book_versions(self.repo_name, book_ids)
+        books_index_version = myservice().bump_books_index_version(self.repo_name)
+        self.invalidate_books([book_id for book_id in book_ids if book_id in self.materialized_books])
+        if self.books_index.is_built():
+            myservice().job_runner.submit(
+                'refresh_books_index', self.books_index.refresh, book_ids, books_index_version)
+
+    def cache_stats(self):
+        with self.canvas_books_lock:
+            canvases_count = len(self.canvas_books)
+        return {
+            "books": self.materialized_books.stats(),
+            "canvases": {"size": canvases_count},
+            "resource_links": self.resource_links.stats()
+        }
+
+    def _object_details(self, object_id):
         obj = db_helper.read_by_id(self.colln, object_id)
+        if obj is None:
+            return None
         obj_meta = {
             "metadata": obj.get("metadata", []),
         }
@@ -43,17 +386,38 @@ class UllekhanamPreziInterface(ServicePreziInterface):
             "sequence_ids": []
         }
 
-    def sequence_details(self, object_id, sequence_id):
-        # meta, canvases
-        # TODO should implement sequences
-        if sequence_id != 'default':
-            return None
-        return self._default_sequence_details(object_id)
+    def _canvases_details(self, sequence_id, canvas_ids):
+        if not len(canvas_ids):
+            return OrderedDict()
+        canvas_oids = [ObjectId(_id) if ObjectId.is_valid(_id) else _id for _id in canvas_ids]
+        sprs = db_helper.read_and_do(
+            self.colln, {"_id": {"$in": canvas_oids}}, OrderedDict(),
+            fields=['_id', 'label', 'jsonClassLabel:', 'metadata'], return_generator=True)
+        sprs_by_id = dict((str(spr['_id']), spr) for spr in sprs)
 
-    def canvas_details(self, sequence_id, canvas_id):
-        # meta, image_id or (image_ids and dimensions)
+        source_image_ids = {}
+        file_annos = db_helper.read_and_do(
+            self.colln, {"jsonClass": "FileAnnotation", "target": {"$in": list(canvas_ids)}}, OrderedDict(),
+            fields=['_id', 'target'], return_generator=True)
+        for file_anno in file_annos:
+            source_image_ids.setdefault(file_anno['target'], []).append(file_anno['_id'])
+
+        canvases = OrderedDict()
+        for canvas_id in canvas_ids:
+            spr = sprs_by_id.get(canvas_id)
+            canvases[canvas_id] = None if spr is None else self._make_canvas_details(
+                spr, source_image_ids.get(canvas_id, []))
+        return canvases
+
+    def _canvas_details(self, sequence_id, canvas_id):
         # TODO optimize url
         spr = db_helper.read_by_id(self.colln, canvas_id)
+        if spr is None:
+            return None
+        source_images = db_helper.files(self.colln, canvas_id)
+        return self._make_canvas_details(spr, [file['_id'] for file in source_images])
+
+    def _make_canvas_details(self, spr, source_image_ids):
         label = spr.get('label', spr.get('jsonClassLabel:', 'page:'))  # TODO
         meta = {
             "metadata": spr.get("metadata", [])
@@ -61,28 +425,52 @@ class UllekhanamPreziInterface(ServicePreziInterface):
         meta.update({
             'label': label
         })
-
-        source_images = db_helper.files(self.colln, canvas_id)
-        source_image_ids = [file['_id'] for file in source_images]
         self._index_metadata(meta)
         return {
             "meta": meta,
             "image_id": source_image_ids[0] if len(source_image_ids) else None
         }
 
-    def _default_collection_details(self):
+    def collection_page_uri(self, requested_collection_id, collection_id):
+        """
+        resolvable uri of a collection page. built from page_uri_template if configured,
+        else from url of current request, (which is of requested_collection_id), by swapping collection id in it.
+        """
+        quoted_collection_id = quote(collection_id, safe='@')
+        url_root = request.url_root if has_request_context() else ''
+        if self.collection_page_uri_template is not None:
+            return self.collection_page_uri_template.format(url_root=url_root, collection_id=quoted_collection_id)
+        if has_request_context():
+            path_prefix, sep, path_suffix = request.path.rpartition('/' + requested_collection_id)
+            if sep:
+                return '{}{}/{}{}'.format(
+                    request.url_root.rstrip('/'), quote(path_prefix), quoted_collection_id, quote(path_suffix))
+        return collection_id
+
+    def _default_collection_details(self, requested_collection_id, page_token=None):
         # until we implement collections, and ways to populate them,
-        # default one will be dynamically generated with all books
-        ops = OrderedDict([
-            ('sort', [[["title.chars", 1]]])
-        ])
-        books = db_helper.read_and_do(self.colln, {"jsonClass": "BookPortion"}, ops=ops, fields=['_id', 'title.chars'])
+        # default one will be dynamically generated with all books.
+        # it is paged by keyset on (title, _id), with ordered keys kept in books_index.
+        after_key = None
+        if page_token is not None:
+            after_key = self.books_index.decode_page_token(page_token)
+            if after_key is None:
+                raise BadRequest('invalid page token in collection id {}'.format(requested_collection_id))
+        keys = self.books_index.page(after_key, self.collection_page_size + 1)
+        has_next = len(keys) > self.collection_page_size
+        keys = keys[:self.collection_page_size]
 
+        next_collection_id = 'books@{}'.format(self.books_index.encode_page_token(keys[-1])) if has_next else None
+        meta = {
+            "label": "books",
+            "total": len(self.books_index),
+            "first": self.collection_page_uri(requested_collection_id, 'books'),
+            "next": self.collection_page_uri(
+                requested_collection_id, next_collection_id) if next_collection_id is not None else None
+        }
         return {
-            "meta": {
-                "label": "books"
-            },
-            "object_ids": [book['_id'] for book in books]
+            "meta": meta,
+            "object_ids": [book_id for title, book_id in keys]
         }
 
     def _default_sequence_details(self, object_id):
@@ -100,19 +488,62 @@ class UllekhanamPreziInterface(ServicePreziInterface):
 
 
 class UllekhanamFSHelper(ServiceFSHelper):
+    """
+    resolved paths of file annotations are cached per process. entries are stamped with repo's write version,
+    and are resolved again if it changed (checked at most every revalidate_seconds),
+    or if their file is not there any more, so that file replacements through other processes are caught up with.
+    """
 
     def __init__(self, repo_name):
         super(UllekhanamFSHelper, self).__init__(repo_name)
 
         self.colln = myservice().colln(self.repo_name)
+        cache_config = myservice().config.get('resolved_paths_cache', {})
+        self.resolved_paths = LRUTTLCache(
+            max_size=cache_config.get('max_size', 10000), ttl=cache_config.get('ttl', 300))
+        self.revalidate_seconds = cache_config.get('revalidate_seconds', 5)
 
     def resolve_to_absolute_path(self, file_anno_id):
-        file_anno = JsonObject.make_from_dict(db_helper.read_by_id(self.colln, file_anno_id))
+        resolved_file = self.resolve_file(file_anno_id)
+        return resolved_file[0] if resolved_file is not None else None
+
+    def resolve_file(self, file_anno_id):
+        """
+        :return: (absolute file path, file name as uploaded), or None, if there is no such file annotation.
+        """
+        entry = self.resolved_paths.get(file_anno_id)
+        if entry is not None and self._is_current(entry):
+            return entry['resolved_file']
+
+        # read before resolving, so that a write racing with it leaves entry stale, and not current.
+        write_version = myservice().write_version(self.repo_name)
+        file_anno = db_helper.read_by_id(self.colln, file_anno_id)
         if file_anno is None:
             return None
 
-        custodian_resource_id = file_anno.target
-        file_path_in_resource_scope = file_anno.body.path
-        file_path = myservice().resource_file_path(
+        custodian_resource_id = file_anno['target']
+        file_path_in_resource_scope = file_anno['body']['path']
+        file_path = myservice().file_path(
             self.repo_name, custodian_resource_id, file_path_in_resource_scope)
-        return file_path
+        blob_reference = parse_path_reference(file_path_in_resource_scope)
+        file_name = blob_reference[1] if blob_reference is not None else os.path.basename(file_path_in_resource_scope)
+        resolved_file = (file_path, file_name)
+        self.resolved_paths.put(file_anno_id, {
+            "resolved_file": resolved_file, "write_version": write_version, "validated_at": time.time()})
+        return resolved_file
+
+    def _is_current(self, entry):
+        if not os.path.isfile(entry['resolved_file'][0]):
+            return False
+        if time.time() - entry['validated_at'] < self.revalidate_seconds:
+            return True
+        if myservice().write_version(self.repo_name) != entry['write_version']:
+            return False
+        entry['validated_at'] = time.time()
+        return True
+
+    def invalidate(self, file_anno_ids):
+        self.resolved_paths.invalidate(file_anno_ids)
+
+    def cache_stats(self):
+        return self.resolved_paths.stats()
@@ -0,0 +1,267 @@
+import json
+import logging
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import has_request_context, copy_current_request_context
+from pymongo import DESCENDING
+
+
+class Job(object):
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    # progress is persisted at most this often (in seconds), to keep it cheap for fine grained reporters.
+    progress_persist_interval = 1
+    # results bigger than this (in bytes of json) are not kept; mongo documents cannot exceed 16MB.
+    max_result_size = 4 * 1024 * 1024
+
+    def __init__(self, job_id, name, submitted_by=None, store=None):
+        self.job_id = job_id
+        self.name = name
+        self.submitted_by = submitted_by
+        self.store = store  # type: JobStore
+        self.status = self.PENDING
+        self.progress = None
+        self.result = None
+        self.error = None
+        self.error_details = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.updated = self.created
+        self.persisted_at = None
+
+    def to_json_map(self, include_result=True):
+        job_json = {
+            "job_id": self.job_id,
+            "name": self.name,
+            "submitted_by": self.submitted_by,
+            "status": self.status,
+            "progress": self.progress,
+            "error": self.error,
+            "error_details": self.error_details,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "updated": self.updated
+        }
+        if include_result:
+            job_json['result'] = self.result
+        return job_json
+
+    def persist(self):
+        """
+        :return: whether job is persisted (or there is no store to persist into).
+        """
+        self.updated = time.time()
+        if self.store is None:
+            return True
+        # noinspection PyBroadException
+        try:
+            self.store.save(self)
+            self.persisted_at = self.updated
+            return True
+        except Exception:
+            logging.error('could not persist job {}: {}'.format(self.job_id, traceback.format_exc()))
+            return False
+
+    def set_result(self, result):
+        result_size = len(json.dumps(result, default=str))
+        if result_size > self.max_result_size:
+            self.result = {"omitted": True, "size_bytes": result_size}
+        else:
+            self.result = result
+
+    def is_finished(self):
+        return self.status in (self.SUCCEEDED, self.FAILED)
+
+    def report_progress(self, done, total=None, message=None):
+        self.progress = {"done": done, "total": total, "message": message}
+        if self.persisted_at is None or time.time() - self.persisted_at >= self.progress_persist_interval:
+            self.persist()
+        else:
+            self.updated = time.time()
+
+
+class JobStore(object):
+    """
+    persists jobs of a repo in a sidecar collection, so that their status and results
+    can be fetched from any worker process, and survive restarts.
+    """
+
+    def __init__(self, mongo_colln):
+        self.mongo_colln = mongo_colln
+
+    def ensure_indexes(self):
+        self.mongo_colln.create_index([('created', DESCENDING)], name='created_-1', background=True)
+
+    def save(self, job):
+        job_json = job.to_json_map()
+        job_json['_id'] = job.job_id
+        self.mongo_colln.replace_one({"_id": job.job_id}, job_json, upsert=True)
+
+    def get(self, job_id):
+        job_json = self.mongo_colln.find_one({"_id": job_id})
+        if job_json is not None:
+            job_json.pop('_id', None)
+        return job_json
+
+    def touch(self, job_ids):
+        """
+        heartbeat of jobs running in this process.
+        """
+        self.mongo_colln.update_many(
+            {"_id": {"$in": list(job_ids)}, "status": {"$in": [Job.PENDING, Job.RUNNING]}},
+            {"$set": {"updated": time.time()}})
+
+    def fail_stale_jobs(self, stale_seconds):
+        """
+        marks jobs, which are pending or running, but whose process stopped updating them
+        (like on a restart), as failed.
+        """
+        now = time.time()
+        result = self.mongo_colln.update_many(
+            {"status": {"$in": [Job.PENDING, Job.RUNNING]}, "updated": {"$lt": now - stale_seconds}},
+            {"$set": {"status": Job.FAILED, "error": "interrupted; process running the job stopped",
+                      "finished": now, "updated": now}})
+        return result.modified_count
+
+    def list(self, limit=50, status=None, submitted_by=None):
+        selector_doc = {}
+        if status is not None:
+            selector_doc['status'] = status
+        if submitted_by is not None:
+            selector_doc['submitted_by'] = submitted_by
+        cursor = self.mongo_colln.find(selector_doc, projection={"_id": False, "result": False})
+        return list(cursor.sort([('created', DESCENDING)]).limit(limit))
+
+
+class JobRunner(object):
+    """
+    runs long running work (tree ingestion, cascading deletes, file cleanups, ...) on a thread pool,
+    outside of request, and keeps track of it's status, so that clients can poll.
+    when submitted during a request, work runs in a copy of that request's context,
+    so that repo and user bound helpers work as they would in request.
+    """
+
+    # running jobs are marked alive in their stores this often; jobs not updated for stale_seconds are interrupted.
+    heartbeat_interval = 30
+    stale_seconds = 120
+    # finished jobs kept only in memory (without a store, or not persisted) are evicted after this many seconds,
+    # or when there are more than max_finished_jobs of them, oldest first.
+    finished_jobs_ttl = 3600
+    max_finished_jobs = 1000
+
+    def __init__(self, max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        heartbeat_thread = threading.Thread(target=self._heartbeat, name='job_heartbeat')
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self.lock:
+                active_jobs = [job for job in self.jobs.values() if job.store is not None and not job.is_finished()]
+            job_ids_by_store = {}
+            for job in active_jobs:
+                job_ids_by_store.setdefault(job.store, []).append(job.job_id)
+            for store, job_ids in job_ids_by_store.items():
+                # noinspection PyBroadException
+                try:
+                    store.touch(job_ids)
+                except Exception:
+                    logging.error('could not update heartbeat of jobs: {}'.format(traceback.format_exc()))
+
+    def submit(self, name, fn, *args, **kwargs):
+        """
+        submits fn(*args, **kwargs) as a job. following keyword arguments are for runner itself:
+
+        :param job_store: JobStore to persist job into.
+        :param submitted_by: id of user submitting the job.
+        :param with_progress: if true, fn is passed a ``progress(done, total=None, message=None)`` callback.
+        """
+        store = kwargs.pop('job_store', None)
+        submitted_by = kwargs.pop('submitted_by', None)
+        with_progress = kwargs.pop('with_progress', False)
+
+        job = Job(uuid.uuid4().hex, name, submitted_by=submitted_by, store=store)
+        if with_progress:
+            kwargs['progress'] = job.report_progress
+        with self.lock:
+            self._evict_finished_jobs()
+            self.jobs[job.job_id] = job
+        job.persist()
+
+        def run():
+            self._run(job, fn, args, kwargs)
+
+        if has_request_context():
+            run = copy_current_request_context(run)
+        self.executor.submit(run)
+        return job
+
+    def _evict_finished_jobs(self):
+        # called with lock held
+        finished_jobs = sorted(
+            [job for job in self.jobs.values() if job.is_finished()], key=lambda job: job.finished)
+        expired_before = time.time() - self.finished_jobs_ttl
+        excess_count = len(finished_jobs) - self.max_finished_jobs
+        for n, job in enumerate(finished_jobs):
+            if n < excess_count or job.finished < expired_before:
+                self.jobs.pop(job.job_id, None)
+
+    def get(self, job_id, store=None):
+        """
+        :return: job's json map, either from this process, or from store.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id, None)
+        if job is not None:
+            return job.to_json_map()
+        if store is not None:
+            job_json = store.get(job_id)
+            if job_json is not None and job_json['status'] in (Job.PENDING, Job.RUNNING) \
+                    and job_json['updated'] < time.time() - self.stale_seconds:
+                # process running it stopped, and it was not yet marked at a startup.
+                job_json['status'] = Job.FAILED
+                job_json['error'] = 'interrupted; process running the job stopped'
+            return job_json
+        return None
+
+    # noinspection PyBroadException
+    def _run(self, job, fn, args, kwargs):
+        job.status = Job.RUNNING
+        job.started = time.time()
+        job.persist()
+        try:
+            job.set_result(fn(*args, **kwargs))
+            job.status = Job.SUCCEEDED
+        except Exception as e:
+            logging.error('job {} ({}) failed: {}'.format(job.job_id, job.name, traceback.format_exc()))
+            job.error = str(e)
+            if hasattr(e, 'to_json_map'):
+                job.error_details = e.to_json_map()
+            job.status = Job.FAILED
+        job.finished = time.time()
+        persisted = job.persist()
+        if not persisted:
+            # like a result, which mongo could not take; record failure at least, so that pollers don't wait forever.
+            job.status = Job.FAILED
+            job.error = 'job finished, but could not be persisted'
+            job.result = None
+            job.error_details = None
+            persisted = job.persist()
+        with self.lock:
+            # finished jobs are served from store, once they are there.
+            if job.store is not None and persisted:
+                self.jobs.pop(job.job_id, None)
@@ -0,0 +1,236 @@
+"""
+in process metrics of api, rendered in prometheus text format.
+
+requests are timed by blueprint hooks, and db calls by an instrumented proxy around collection handles.
+recording is a lock protected increment of few counters, cheap enough to be always on.
+"""
+import bisect
+import threading
+import time
+import weakref
+
+from flask import g, has_app_context
+
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+size_buckets = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+count_buckets = (0, 1, 2, 5, 10, 20, 50, 100, 500, 1000)
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values)) + (extra or [])
+    if not len(pairs):
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+
+class Counter(object):
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_values=(), amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} counter'.format(self.name)]
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in sorted(values):
+            lines.append('{}{} {}'.format(self.name, _format_labels(self.label_names, label_values), value))
+        return lines
+
+
+class Histogram(object):
+
+    def __init__(self, name, description, buckets, label_names=()):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.label_names = label_names
+        # label values -> [bucket counts..., sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, label_values=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(label_values, None)
+            if state is None:
+                state = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            values = [(label_values, list(state)) for label_values, state in self.values.items()]
+        for label_values, state in sorted(values):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, state):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _format_labels(self.label_names, label_values, [('le', bound)]), cumulative))
+            lines.append('{}_bucket{} {}'.format(
+                self.name, _format_labels(self.label_names, label_values, [('le', '+Inf')]), state[-1]))
+            labels = _format_labels(self.label_names, label_values)
+            lines.append('{}_sum{} {}'.format(self.name, labels, state[-2]))
+            lines.append('{}_count{} {}'.format(self.name, labels, state[-1]))
+        return lines
+
+
+class ApiMetrics(object):
+
+    def __init__(self):
+        route_labels = ('method', 'route')
+        self.request_duration = Histogram(
+            'ullekhanam_http_request_duration_seconds', 'time taken by requests, till response is returned',
+            latency_buckets, route_labels + ('status',))
+        self.response_size = Histogram(
+            'ullekhanam_http_response_size_bytes', 'size of non streamed response bodies', size_buckets, route_labels)
+        self.request_db_calls = Histogram(
+            'ullekhanam_http_request_db_calls', 'number of db calls made by a request', count_buckets, route_labels)
+        self.request_db_duration = Histogram(
+            'ullekhanam_http_request_db_duration_seconds', 'time spent by a request in db calls',
+            latency_buckets, route_labels)
+        self.db_calls = Counter(
+            'ullekhanam_db_calls_total', 'db calls, by collection layer and operation', ('layer', 'operation'))
+        self.db_duration = Counter(
+            'ullekhanam_db_call_duration_seconds_total', 'time spent in db calls, by collection layer and operation',
+            ('layer', 'operation'))
+
+    def record_db_call(self, layer, operation, seconds):
+        self.db_calls.inc((layer, operation))
+        self.db_duration.inc((layer, operation), seconds)
+        if has_app_context():
+            request_db_stats = g.get('ullekhanam_db_stats', None)
+            if request_db_stats is not None:
+                request_db_stats[0] += 1
+                request_db_stats[1] += seconds
+
+    def request_started(self):
+        g.ullekhanam_request_start = time.perf_counter()
+        # [calls, seconds]
+        g.ullekhanam_db_stats = [0, 0.0]
+
+    def request_finished(self, route, method, response):
+        start = g.get('ullekhanam_request_start', None)
+        if start is None:
+            return
+        route_labels = (method, route)
+        self.request_duration.observe(time.perf_counter() - start, route_labels + (response.status_code,))
+        if not response.is_streamed:
+            self.response_size.observe(response.calculate_content_length() or 0, route_labels)
+        db_calls, db_seconds = g.ullekhanam_db_stats
+        self.request_db_calls.observe(db_calls, route_labels)
+        self.request_db_duration.observe(db_seconds, route_labels)
+
+    def render(self):
+        lines = []
+        for metric in (
+                self.request_duration, self.response_size, self.request_db_calls, self.request_db_duration,
+                self.db_calls, self.db_duration):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class TimedCursor(object):
+    """
+    proxy of a cursor (or generator) returned by a db call, which adds time spent in fetching from it to call's time.
+    call is recorded once cursor is exhausted, closed, or garbage collected.
+    """
+
+    def __init__(self, cursor, record, elapsed):
+        self._cursor = cursor
+        # [elapsed seconds], shared with finalizer, which should not refer to self.
+        self._elapsed = [elapsed]
+        self._finalizer = weakref.finalize(self, lambda state: record(state[0]), self._elapsed)
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        def chained(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            finally:
+                self._elapsed[0] += time.perf_counter() - start
+            # builder methods like sort, skip and limit return cursor itself.
+            return self if result is self._cursor else result
+
+        return chained
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            item = next(self._cursor)
+        except StopIteration:
+            self._elapsed[0] += time.perf_counter() - start
+            self._finalizer()
+            raise
+        self._elapsed[0] += time.perf_counter() - start
+        return item
+
+    def close(self):
+        self._finalizer()
+        if hasattr(self._cursor, 'close'):
+            self._cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class InstrumentedCollection(object):
+    """
+    transparent proxy of a collection handle, which times every method call on it,
+    including iteration of cursors and generators returned by them.
+    mongo_collection of a MyDbCollection is handed out instrumented too, as 'mongo' layer.
+    """
+
+    def __init__(self, colln, metrics, layer='objectdb'):
+        self._colln = colln
+        self._metrics = metrics
+        self._layer = layer
+
+    def __getattr__(self, name):
+        attr = getattr(self._colln, name)
+        if name == 'mongo_collection':
+            return InstrumentedCollection(attr, self._metrics, layer='mongo')
+        if not callable(attr):
+            return attr
+        metrics = self._metrics
+        layer = self._layer
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception:
+                metrics.record_db_call(layer, name, time.perf_counter() - start)
+                raise
+            elapsed = time.perf_counter() - start
+            if hasattr(result, '__next__') and not isinstance(result, dict):
+                return TimedCursor(result, lambda seconds: metrics.record_db_call(layer, name, seconds), elapsed)
+            metrics.record_db_call(layer, name, elapsed)
+            return result
+
+        return timed
+
+    def __repr__(self):
+        return 'InstrumentedCollection({!r})'.format(self._colln)
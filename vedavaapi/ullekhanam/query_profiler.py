@@ -0,0 +1,267 @@
+"""
+profiler of queries made on repo's collection.
+
+queries are grouped by their shape (field names and operators, without values),
+and count, latency percentiles and slow query counts are aggregated per shape.
+queries slower than threshold are logged, and their shape is explained once, in background,
+so that shapes which need an index can be found.
+explains are run directly on mongo collection. for shapes recorded at objectdb layer, which may rewrite queries,
+the plan is of the filter as given, and may differ from what objectdb actually runs.
+"""
+import json
+import logging
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import db_indexes
+
+# operations whose first argument is a filter document.
+filtered_operations = (
+    'find', 'find_one', 'count', 'count_documents', 'delete_one', 'delete_many',
+    'update_one', 'update_many', 'replace_one', 'find_one_and_update', 'find_one_and_replace', 'find_one_and_delete'
+)
+# operations whose shapes can be explained with a find.
+explainable_operations = ('find', 'find_one', 'count', 'count_documents')
+
+_logical_operators = ('$and', '$or', '$nor')
+
+
+def normalized_shape(value):
+    """
+    shape of a filter; field names and operators are kept, values are replaced with '?'.
+    """
+    if isinstance(value, dict):
+        shape = {}
+        for key, sub_value in value.items():
+            if key in _logical_operators and isinstance(sub_value, list):
+                sub_shapes = set(json.dumps(normalized_shape(clause), sort_keys=True) for clause in sub_value)
+                shape[key] = [json.loads(sub_shape) for sub_shape in sorted(sub_shapes)]
+            elif isinstance(sub_value, dict) and any(k.startswith('$') for k in sub_value.keys()):
+                shape[key] = normalized_shape(sub_value)
+            else:
+                shape[key] = '?'
+        return shape
+    return '?'
+
+
+def sort_shape(sort_args, sort_kwargs):
+    if not len(sort_args):
+        return None
+    key_or_list = sort_args[0]
+    if isinstance(key_or_list, str):
+        return [[key_or_list, sort_kwargs.get('direction', sort_args[1] if len(sort_args) > 1 else 1)]]
+    return [list(item) for item in key_or_list]
+
+
+def _percentile(sorted_values, fraction):
+    if not len(sorted_values):
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class ShapeStats(object):
+
+    def __init__(self, layer, operation, shape, sort, samples_count):
+        self.layer = layer
+        self.operation = operation
+        self.shape = shape
+        self.sort = sort
+        self.count = 0
+        self.total_seconds = 0
+        self.max_seconds = 0
+        self.slow_count = 0
+        self.samples = deque(maxlen=samples_count)
+        self.explain = None
+        self.explain_submitted = False
+
+    def to_json_map(self):
+        samples = sorted(self.samples)
+        return {
+            "layer": self.layer,
+            "operation": self.operation,
+            "shape": self.shape,
+            "sort": self.sort,
+            "count": self.count,
+            "total_seconds": self.total_seconds,
+            "mean_seconds": self.total_seconds / self.count if self.count else None,
+            "p50_seconds": _percentile(samples, 0.5),
+            "p99_seconds": _percentile(samples, 0.99),
+            "max_seconds": self.max_seconds,
+            "slow_count": self.slow_count,
+            "explain": self.explain,
+            "explain_note": None if self.layer == 'mongo' or self.explain is None else
+            'explained as a direct mongo query; objectdb may run it differently'
+        }
+
+
+class QueryProfiler(object):
+
+    def __init__(self, mongo_colln, slow_query_ms=200, max_shapes=1000, samples_per_shape=1000, explain_workers=1):
+        """
+        :param mongo_colln: raw collection, on which slow shapes are explained.
+        :param explain_workers: explains run on their own small pool, so that they don't hold up jobs of service.
+        """
+        self.mongo_colln = mongo_colln
+        self.explain_executor = ThreadPoolExecutor(max_workers=explain_workers)
+        self.slow_query_seconds = slow_query_ms / 1000.0
+        self.max_shapes = max_shapes
+        self.samples_per_shape = samples_per_shape
+        self.shapes = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def record(self, layer, operation, filter_doc, sort, seconds):
+        shape = normalized_shape(filter_doc) if filter_doc is not None else None
+        key = json.dumps([layer, operation, shape, sort], sort_keys=True, default=str)
+        explain_needed = False
+        with self.lock:
+            stats = self.shapes.get(key, None)
+            if stats is None:
+                if len(self.shapes) >= self.max_shapes:
+                    # too many distinct shapes; rest are aggregated together.
+                    key = json.dumps([layer, operation, 'other', None])
+                    stats = self.shapes.get(key, None)
+                    shape, sort = 'other', None
+                if stats is None:
+                    stats = self.shapes[key] = ShapeStats(layer, operation, shape, sort, self.samples_per_shape)
+            stats.count += 1
+            stats.total_seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.samples.append(seconds)
+            if seconds >= self.slow_query_seconds:
+                stats.slow_count += 1
+                if not stats.explain_submitted and operation in explainable_operations and shape != 'other':
+                    stats.explain_submitted = explain_needed = True
+
+        if seconds < self.slow_query_seconds:
+            return
+        logging.warning('slow query ({:.0f} ms): {} {} {} sort {}'.format(
+            seconds * 1000, layer, operation, json.dumps(shape, sort_keys=True), sort))
+        if explain_needed:
+            # explained with values of this very query, as shape alone cannot be run.
+            self.explain_executor.submit(self._explain, stats, filter_doc, sort)
+
+    def _explain(self, stats, filter_doc, sort):
+        try:
+            summary = db_indexes.explain_summary(
+                self.mongo_colln, filter_doc, sort=[tuple(item) for item in sort] if sort else None)
+        except Exception as e:
+            logging.warning('could not explain slow query shape {}: {}'.format(json.dumps(stats.shape), e))
+            return None
+        stats.explain = summary
+        logging.warning('explain of slow query shape {} sort {}: {}'.format(
+            json.dumps(stats.shape, sort_keys=True), stats.sort, summary))
+        return summary
+
+    def report(self, limit=100):
+        with self.lock:
+            shapes = [stats.to_json_map() for stats in self.shapes.values()]
+        shapes.sort(key=lambda s: s['total_seconds'], reverse=True)
+        return {
+            "since": self.started,
+            "slow_query_ms": self.slow_query_seconds * 1000,
+            "shapes_count": len(shapes),
+            "shapes": shapes[:limit]
+        }
+
+    def reset(self):
+        with self.lock:
+            self.shapes = {}
+            self.started = time.time()
+
+
+class ProfiledCursor(object):
+    """
+    proxy of a cursor, which accumulates time spent in fetching from it, and records the query once it is exhausted.
+    cursors abandoned before exhaustion are recorded when closed, or when garbage collected.
+    """
+
+    def __init__(self, cursor, on_done, elapsed):
+        self._cursor = cursor
+        # [sort, elapsed seconds], shared with finalizer, which should not refer to self.
+        self._state = [None, elapsed]
+        self._record = weakref.finalize(self, lambda state: on_done(state[0], state[1]), self._state)
+
+    def sort(self, *args, **kwargs):
+        self._state[0] = sort_shape(args, kwargs)
+        self._cursor.sort(*args, **kwargs)
+        return self
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        def chained(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            # builder methods like skip and limit return cursor itself.
+            return self if result is self._cursor else result
+
+        return chained
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            item = next(self._cursor)
+        except StopIteration:
+            self._state[1] += time.perf_counter() - start
+            self._record()
+            raise
+        self._state[1] += time.perf_counter() - start
+        return item
+
+    def close(self):
+        self._record()
+        if hasattr(self._cursor, 'close'):
+            self._cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ProfiledCollection(object):
+    """
+    transparent proxy of a collection handle, which profiles filtered operations on it.
+    mongo_collection of a MyDbCollection is handed out profiled too, as 'mongo' layer.
+    """
+
+    def __init__(self, colln, profiler, layer='objectdb'):
+        self._colln = colln
+        self._profiler = profiler
+        self._layer = layer
+
+    def __getattr__(self, name):
+        attr = getattr(self._colln, name)
+        if name == 'mongo_collection':
+            return ProfiledCollection(attr, self._profiler, layer='mongo')
+        if name not in filtered_operations or not callable(attr):
+            return attr
+        profiler = self._profiler
+        layer = self._layer
+
+        def profiled(*args, **kwargs):
+            filter_doc = args[0] if len(args) else kwargs.get('filter', kwargs.get('query', None))
+            if not isinstance(filter_doc, dict):
+                filter_doc = None
+            start = time.perf_counter()
+            result = attr(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+            if hasattr(result, '__next__') and not isinstance(result, dict):
+                return ProfiledCursor(
+                    result, lambda sort, seconds: profiler.record(layer, name, filter_doc, sort, seconds), elapsed)
+            profiler.record(layer, name, filter_doc, None, elapsed)
+            return result
+
+        return profiled
+
+    def __repr__(self):
+        return 'ProfiledCollection({!r})'.format(self._colln)
@@ -0,0 +1,38 @@
+"""
+json schemas and contexts of all JsonObject classes, pre-encoded once as response payloads.
+they don't change during life of process, but are fetched by clients on every page load.
+"""
+import gzip
+import hashlib
+import json
+
+
+class Payload(object):
+
+    def __init__(self, body):
+        self.raw = json.dumps(body, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        self.gzipped = gzip.compress(self.raw)
+        # derived from content, so same in all worker processes.
+        self.etag = hashlib.sha1(self.raw).hexdigest()
+
+
+class SchemaPayloads(object):
+    """
+    payloads of /schemas, /contexts, and of their per class variants.
+    """
+
+    def __init__(self):
+        from sanskrit_ld.schema import json_class_registry
+
+        schemas = {}
+        contexts = {}
+        for json_class, class_obj in json_class_registry.items():
+            if hasattr(class_obj, 'schema'):
+                schemas[json_class] = class_obj.schema
+            if hasattr(class_obj, 'context'):
+                contexts[json_class] = class_obj.context
+
+        self.all_schemas = Payload(schemas)
+        self.all_contexts = Payload(contexts)
+        self.schemas = dict((json_class, Payload(schema)) for json_class, schema in schemas.items())
+        self.contexts = dict((json_class, Payload(context)) for json_class, context in contexts.items())
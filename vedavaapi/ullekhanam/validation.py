@@ -0,0 +1,110 @@
+"""
+schema validation of JsonObjects, with compiled validators cached per class.
+
+JsonObject.validate checks object against it's class's schema from scratch every time, including the schema itself.
+here a validator is compiled once per class (at startup with prime_validators, or on first use),
+and reused for every object of that class.
+classes which add their own checks by overriding validate, or any of validate_* hooks it calls,
+are validated by their validate, as before.
+"""
+import logging
+
+import jsonschema
+from sanskrit_ld.schema import JsonObject
+
+
+_validators = {}
+# class -> whether it has it's own validation
+_custom_validation = {}
+
+
+def _defining_class(klass, name):
+    for mro_class in klass.__mro__:
+        if name in mro_class.__dict__:
+            return mro_class
+    return None
+
+
+def _has_custom_validation(json_object_class):
+    """
+    whether class overrides validate, or any other hook of validation chain (validate_schema, ...).
+    validation of such classes is left to their own validate.
+    """
+    has_custom_validation = _custom_validation.get(json_object_class, None)
+    if has_custom_validation is None:
+        has_custom_validation = _custom_validation[json_object_class] = any(
+            _defining_class(json_object_class, name) not in JsonObject.__mro__
+            for name in dir(json_object_class) if name.startswith('validate'))
+    return has_custom_validation
+
+
+def compiled_validator(json_object_class):
+    validator = _validators.get(json_object_class, None)
+    if validator is None:
+        schema = json_object_class.schema
+        validator_class = jsonschema.validators.validator_for(schema)
+        validator_class.check_schema(schema)
+        validator = validator_class(schema)
+        # concurrent first uses may compile twice, but result is same.
+        _validators[json_object_class] = validator
+    return validator
+
+
+def _json_object_classes(base_class=JsonObject):
+    for subclass in base_class.__subclasses__():
+        yield subclass
+        for sub_subclass in _json_object_classes(subclass):
+            yield sub_subclass
+
+
+def prime_validators():
+    """
+    compiles validators of all loaded JsonObject classes.
+    """
+    compiled_count = 0
+    for json_object_class in set(_json_object_classes()):
+        if _has_custom_validation(json_object_class) or not hasattr(json_object_class, 'schema'):
+            continue
+        # noinspection PyBroadException
+        try:
+            compiled_validator(json_object_class)
+            compiled_count += 1
+        except Exception as e:
+            logging.warning('could not compile schema of {}: {}'.format(json_object_class.__name__, e))
+    return compiled_count
+
+
+def validate(json_object):
+    """
+    raises jsonschema.ValidationError, (or whatever class's own validate raises), if object is invalid.
+    """
+    json_object_class = type(json_object)
+    if _has_custom_validation(json_object_class):
+        json_object.validate()
+        return
+    compiled_validator(json_object_class).validate(json_object.to_json_map())
+
+
+def validate_many(json_objects):
+    """
+    validates a batch of objects, with validator of each class looked up once.
+
+    :return: list of (index, error message) of invalid objects.
+    """
+    errors = []
+    validators = {}
+    for n, json_object in enumerate(json_objects):
+        json_object_class = type(json_object)
+        # noinspection PyBroadException
+        try:
+            if json_object_class not in validators:
+                validators[json_object_class] = None if _has_custom_validation(json_object_class) \
+                    else compiled_validator(json_object_class)
+            validator = validators[json_object_class]
+            if validator is None:
+                json_object.validate()
+            else:
+                validator.validate(json_object.to_json_map())
+        except Exception as e:
+            errors.append((n, str(e)))
+    return errors